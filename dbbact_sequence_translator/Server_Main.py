@@ -1,12 +1,15 @@
 import os
 
 from flask import Flask, g, request
+from flask.ctx import _AppCtxGlobals
 
 from .autodoc import auto
 from .flask_translate import Translate_Obj
 from .flask_docs import Docs_Flask_Obj
 from .utils import debug, SetDebugLevel
 from . import db_access
+from . import seq_index
+from .mmap_index import MmapPrefixIndex
 
 
 app = Flask(__name__)
@@ -16,27 +19,91 @@ app.register_blueprint(Docs_Flask_Obj)
 auto.init_app(app)
 
 
-# whenever a new request arrives, connect to the database and store in g.db
+# the per-process database connection pool (created on first use since each gunicorn worker needs its own pool)
+_db_pool = None
+_db_pool_pid = None
+
+
+def get_db_pool():
+    '''Get the database connection pool of the current process (creating it if needed)
+
+    Returns
+    -------
+    db_access.TranslatorConnectionPool
+    '''
+    global _db_pool, _db_pool_pid
+
+    if _db_pool is None or _db_pool_pid != os.getpid():
+        _db_pool = db_access.TranslatorConnectionPool(min_size=app.config.get('DBBACT_SEQUENCE_TRANSLATOR_POOL_MIN_SIZE') or 1,
+                                                      max_size=app.config.get('DBBACT_SEQUENCE_TRANSLATOR_POOL_MAX_SIZE') or 10,
+                                                      server_type=app.config.get('DBBACT_SEQUENCE_TRANSLATOR_SERVER_TYPE'),
+                                                      host=app.config.get('DBBACT_SEQUENCE_TRANSLATOR_POSTGRES_HOST'),
+                                                      port=app.config.get('DBBACT_SEQUENCE_TRANSLATOR_POSTGRES_PORT'),
+                                                      database=app.config.get('DBBACT_SEQUENCE_TRANSLATOR_POSTGRES_DATABASE'),
+                                                      user=app.config.get('DBBACT_SEQUENCE_TRANSLATOR_POSTGRES_USER'),
+                                                      password=app.config.get('DBBACT_SEQUENCE_TRANSLATOR_POSTGRES_PASSWORD'))
+        _db_pool_pid = os.getpid()
+    return _db_pool
+
+
+def load_memory_index():
+    '''Load the sequence prefix index for this process (used by /get_ids_for_seqs instead of the database).
+    If DBBACT_SEQUENCE_TRANSLATOR_INDEX_FILE is set, use the memory mapped index file (shared between all workers).
+    Otherwise, if DBBACT_SEQUENCE_TRANSLATOR_MEMORY_INDEX is set, load the SequenceToSequenceTable into memory
+    '''
+    index_file = app.config.get('DBBACT_SEQUENCE_TRANSLATOR_INDEX_FILE')
+    if index_file:
+        debug(2, 'using sequence index file %s' % index_file)
+        seq_index.set_memory_index(MmapPrefixIndex(index_file))
+        return
+    if str(app.config.get('DBBACT_SEQUENCE_TRANSLATOR_MEMORY_INDEX')).lower() not in ('1', 'true', 'yes'):
+        debug(2, 'in-memory sequence index not enabled. using database for sequence lookups')
+        seq_index.set_memory_index(None)
+        return
+    pool = get_db_pool()
+    con, cur = pool.get_connection()
+    try:
+        seq_index.set_memory_index(seq_index.SequencePrefixIndex.load_from_db(con))
+    finally:
+        pool.return_connection(con)
+
+
+class TranslatorGlobals(_AppCtxGlobals):
+    '''The flask g object, with g.con and g.cur connecting to the database only when first used.
+    This way requests not using the database (docs, CORS preflight etc.) do not take a database connection
+    '''
+    @property
+    def con(self):
+        if '_con' not in self.__dict__:
+            self._con, self._cur = get_db_pool().get_connection()
+        return self._con
+
+    @property
+    def cur(self):
+        if '_cur' not in self.__dict__:
+            self.con
+        return self._cur
+
+
+app.app_ctx_globals_class = TranslatorGlobals
+
+
+# whenever a new request arrives, log it. the database connection is borrowed from the pool only when g.con/g.cur is used
 @app.before_request
 def before_request():
     if request.remote_addr != '127.0.0.1':
         debug(6, 'got request for page %s' % request.url, request=request)
     else:
         debug(1, 'got local request for page %s' % request.url, request=request)
-    con, cur = db_access.connect_translator_db(server_type=app.config.get('DBBACT_SEQUENCE_TRANSLATOR_SERVER_TYPE'),
-                                               host=app.config.get('DBBACT_SEQUENCE_TRANSLATOR_POSTGRES_HOST'),
-                                               port=app.config.get('DBBACT_SEQUENCE_TRANSLATOR_POSTGRES_PORT'),
-                                               database=app.config.get('DBBACT_SEQUENCE_TRANSLATOR_POSTGRES_DATABASE'),
-                                               user=app.config.get('DBBACT_SEQUENCE_TRANSLATOR_POSTGRES_USER'),
-                                               password=app.config.get('DBBACT_SEQUENCE_TRANSLATOR_POSTGRES_PASSWORD'))
-    g.con = con
-    g.cur = cur
 
 
-# and when the request is over, disconnect
+# and when the request is over, return the connection to the pool (if we used one)
 @app.teardown_request
 def teardown_request(exception):
-    g.con.close()
+    g.pop('_cur', None)
+    con = g.pop('_con', None)
+    if con is not None:
+        get_db_pool().return_connection(con)
 
 
 # handle the cross-site scripting requests (CORS)
@@ -51,7 +118,7 @@ def after_request(response):
     return response
 
 
-def gunicorn(server_type=None, pg_host=None, pg_port=None, pg_db=None, pg_user=None, pg_pwd=None, debug_level=6):
+def gunicorn(server_type=None, pg_host=None, pg_port=None, pg_db=None, pg_user=None, pg_pwd=None, pool_min_size=None, pool_max_size=None, memory_index=None, index_file=None, debug_level=6):
     '''The entry point for running the sequence translator api server through gunicorn (http://gunicorn.org/)
     to run sequence translator dbbact rest server using gunicorn, use:
 
@@ -65,6 +132,12 @@ def gunicorn(server_type=None, pg_host=None, pg_port=None, pg_db=None, pg_user=N
         None to use the DBBACT_SERVER_TYPE environment variable instead
     pg_host, pg_port, pg_db, pg_user, pg_pwd: str or None, optional
         str to override the env. variable and server_type selected postgres connection parameters
+    pool_min_size, pool_max_size: int or None, optional
+        int to override the env. variable database connection pool size (per worker)
+    memory_index: bool or None, optional
+        bool to override the env. variable enabling the in-memory sequence index (loaded when the worker starts)
+    index_file: str or None, optional
+        str to override the env. variable memory mapped sequence index file name (created by scripts/build_translation_index.py)
     debug_level: int, optional
         The minimal level of debug messages to log (10 is max, ~5 is equivalent to warning)
 
@@ -90,13 +163,24 @@ def gunicorn(server_type=None, pg_host=None, pg_port=None, pg_db=None, pg_user=N
         app.config['DBBACT_SEQUENCE_TRANSLATOR_POSTGRES_PASSWORD'] = pg_user
     if pg_db is not None:
         app.config['DBBACT_SEQUENCE_TRANSLATOR_POSTGRES_DATABASE'] = pg_db
+    if pool_min_size is not None:
+        app.config['DBBACT_SEQUENCE_TRANSLATOR_POOL_MIN_SIZE'] = pool_min_size
+    if pool_max_size is not None:
+        app.config['DBBACT_SEQUENCE_TRANSLATOR_POOL_MAX_SIZE'] = pool_max_size
+    if memory_index is not None:
+        app.config['DBBACT_SEQUENCE_TRANSLATOR_MEMORY_INDEX'] = memory_index
+    if index_file is not None:
+        app.config['DBBACT_SEQUENCE_TRANSLATOR_INDEX_FILE'] = index_file
+    load_memory_index()
 
     return app
 
 
 def set_env_params():
     # set the database access parameters
-    env_params = ['DBBACT_SEQUENCE_TRANSLATOR_SERVER_TYPE', 'DBBACT_SEQUENCE_TRANSLATOR_POSTGRES_HOST', 'DBBACT_SEQUENCE_TRANSLATOR_POSTGRES_PORT', 'DBBACT_SEQUENCE_TRANSLATOR_POSTGRES_DATABASE', 'DBBACT_SEQUENCE_TRANSLATOR_POSTGRES_USER', 'DBBACT_SEQUENCE_TRANSLATOR_POSTGRES_PASSWORD']
+    env_params = ['DBBACT_SEQUENCE_TRANSLATOR_SERVER_TYPE', 'DBBACT_SEQUENCE_TRANSLATOR_POSTGRES_HOST', 'DBBACT_SEQUENCE_TRANSLATOR_POSTGRES_PORT', 'DBBACT_SEQUENCE_TRANSLATOR_POSTGRES_DATABASE', 'DBBACT_SEQUENCE_TRANSLATOR_POSTGRES_USER', 'DBBACT_SEQUENCE_TRANSLATOR_POSTGRES_PASSWORD',
+                  'DBBACT_SEQUENCE_TRANSLATOR_POOL_MIN_SIZE', 'DBBACT_SEQUENCE_TRANSLATOR_POOL_MAX_SIZE', 'DBBACT_SEQUENCE_TRANSLATOR_MEMORY_INDEX',
+                  'DBBACT_SEQUENCE_TRANSLATOR_INDEX_FILE']
     for cparam in env_params:
             cval = os.environ.get(cparam)
             if cval is not None:
@@ -0,0 +1,123 @@
+import io
+import time
+
+from .utils import debug
+
+
+def format_copy_value(value):
+    '''Convert a value to the postgres COPY text format
+
+    Parameters
+    ----------
+    value: None, bytes, list or any value with str()
+        the value to convert. None is converted to NULL, bytes to bytea, list to an array
+
+    Returns
+    -------
+    str: the COPY text format representation of the value
+    '''
+    if value is None:
+        return '\\N'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        # bytea hex format. the backslash is escaped since COPY text format uses backslash escapes
+        return '\\\\x' + bytes(value).hex()
+    if isinstance(value, (list, tuple)):
+        return '{%s}' % ','.join([str(x) for x in value])
+    value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class CopyRowsFile(io.TextIOBase):
+    '''Read-only file-like object streaming rows in the postgres COPY text format from an iterator, for use with cursor.copy_expert().
+    This way the rows are sent to the database while they are generated, without creating the whole COPY data in memory
+    '''
+    def __init__(self, rows):
+        '''
+        Parameters
+        ----------
+        rows: iterator of tuple
+            the rows to stream. each row is a tuple of values (converted using format_copy_value())
+        '''
+        self._rows = iter(rows)
+        self._buffer = ''
+        self.num_rows = 0
+
+    def readable(self):
+        return True
+
+    def _read_line(self):
+        '''Get the next row as a COPY text format line, or '' if no more rows'''
+        row = next(self._rows, None)
+        if row is None:
+            return ''
+        self.num_rows += 1
+        return '\t'.join([format_copy_value(x) for x in row]) + '\n'
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self._buffer + ''.join(iter(self._read_line, ''))
+            self._buffer = ''
+            return data
+        while len(self._buffer) < size:
+            line = self._read_line()
+            if not line:
+                break
+            self._buffer += line
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        if self._buffer:
+            return self.read(size)
+        return self._read_line()
+
+
+def _batches(rows, batch_size):
+    '''Split an iterator of rows into consecutive iterators of at most batch_size rows'''
+    rows = iter(rows)
+    while True:
+        first = next(rows, None)
+        if first is None:
+            return
+        yield _batch(first, rows, batch_size)
+
+
+def _batch(first, rows, batch_size):
+    yield first
+    for _, crow in zip(range(batch_size - 1), rows):
+        yield crow
+
+
+def copy_rows(cur, table, columns, rows, batch_size=100000):
+    '''Insert rows into a table using COPY, streaming the rows from an iterator.
+    A separate COPY command is sent for every batch_size rows. Note the rows are not committed
+
+    Parameters
+    ----------
+    cur: psycopg2 cursor
+    table: str
+        name of the table to insert into
+    columns: list of str
+        names of the columns (same order as the row values)
+    rows: iterator of tuple
+        the rows to insert
+    batch_size: int, optional
+        number of rows in each COPY command
+
+    Returns
+    -------
+    int: the number of rows inserted
+    '''
+    num_rows = 0
+    start_time = time.time()
+    sql = 'COPY %s (%s) FROM STDIN' % (table, ', '.join(columns))
+    for cbatch in _batches(rows, batch_size):
+        cfile = CopyRowsFile(cbatch)
+        cur.copy_expert(sql, cfile)
+        num_rows += cfile.num_rows
+        elapsed = time.time() - start_time
+        debug(1, 'copied %d rows into %s (%.0f rows/sec)' % (num_rows, table, num_rows / max(elapsed, 1e-6)))
+    elapsed = time.time() - start_time
+    debug(2, 'copied %d rows into %s in %.1f sec (%.0f rows/sec)' % (num_rows, table, elapsed, num_rows / max(elapsed, 1e-6)))
+    return num_rows
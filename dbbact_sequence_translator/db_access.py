@@ -1,30 +1,28 @@
+import time
+
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
+import psycopg2.extensions
 
 from .utils import debug
 
+# pooled connections idle for longer than this (seconds) are tested using 'SELECT 1' before handing them out
+HEALTH_CHECK_IDLE_SECONDS = 60
 
-def connect_translator_db(server_type=None, database=None, user=None, password=None, port=None, host=None):
+
+def get_translator_db_params(server_type=None, database=None, user=None, password=None, port=None, host=None):
     """
-    connect to the sequence translator postgres database and return the connection and cursor
+    get the connection parameters for the sequence translator postgres database
 
     Parameters
     ----------
-    server_type: str
-        type of server to connect to. overrides the other default parameters
-        options are:
-            'main', 'develop', 'test'
-    database: str, optional
-        name of the database to connect to (usually 'sequence_translator_dbbact'/'sequence_translator_dbbact_develop'/'sequence_translator_dbbact_test')
-    host: str or False or None
-        False to not pass host parameter
-        None to use server_type defaults
-        str to connect to given host
+    same as connect_translator_db()
 
     Returns
     -------
-    con : the psycopg database connection
-    cur : the psycopg database cursor (DictCursor)
+    dict of {str: str/int}
+        the keyword parameters for psycopg2.connect()
     """
     # set the default values
     chost = False
@@ -60,12 +58,38 @@ def connect_translator_db(server_type=None, database=None, user=None, password=N
         chost = host
     # convert port to number since env. parameter can be str
     cport = int(cport)
+    params = {'database': cdatabase, 'user': cuser, 'password': cpassword, 'port': cport}
+    if chost is not False:
+        params['host'] = chost
+    return params
+
+
+def connect_translator_db(server_type=None, database=None, user=None, password=None, port=None, host=None):
+    """
+    connect to the sequence translator postgres database and return the connection and cursor
+
+    Parameters
+    ----------
+    server_type: str
+        type of server to connect to. overrides the other default parameters
+        options are:
+            'main', 'develop', 'test'
+    database: str, optional
+        name of the database to connect to (usually 'sequence_translator_dbbact'/'sequence_translator_dbbact_develop'/'sequence_translator_dbbact_test')
+    host: str or False or None
+        False to not pass host parameter
+        None to use server_type defaults
+        str to connect to given host
+
+    Returns
+    -------
+    con : the psycopg database connection
+    cur : the psycopg database cursor (DictCursor)
+    """
+    params = get_translator_db_params(server_type=server_type, database=database, user=user, password=password, port=port, host=host)
     try:
-        debug(1, 'connecting host=%s, database=%s, user=%s, port=%d' % (chost, cdatabase, cuser, cport))
-        if chost is False:
-            con = psycopg2.connect(database=cdatabase, user=cuser, password=cpassword, port=cport)
-        else:
-            con = psycopg2.connect(host=chost, database=cdatabase, user=cuser, password=cpassword, port=cport)
+        debug(1, 'connecting host=%s, database=%s, user=%s, port=%d' % (params.get('host', False), params['database'], params['user'], params['port']))
+        con = psycopg2.connect(**params)
         cur = con.cursor(cursor_factory=psycopg2.extras.DictCursor)
         debug(1, 'connected to database')
         return (con, cur)
@@ -74,3 +98,136 @@ def connect_translator_db(server_type=None, database=None, user=None, password=N
         debug(3, msg)
         raise SystemError(msg)
         return None
+
+
+class TranslatorConnectionPool:
+    """
+    A pool of open connections to the sequence translator postgres database.
+    Used by the rest-api server so each request borrows an open connection instead of connecting to the database.
+    Note the pool is not shared between processes (each gunicorn worker needs its own pool)
+    """
+    def __init__(self, min_size=1, max_size=10, health_check=True, health_check_idle=HEALTH_CHECK_IDLE_SECONDS, server_type=None, database=None, user=None, password=None, port=None, host=None):
+        """
+        create the pool and open min_size connections
+
+        Parameters
+        ----------
+        min_size: int, optional
+            number of connections to open when creating the pool (and keep open when returned)
+        max_size: int, optional
+            maximal number of connections open at the same time
+        health_check: bool, optional
+            True to test connections (using 'SELECT 1') before handing them out, and replace them if broken.
+            Only connections not idle (i.e. in a transaction) or idle for more than health_check_idle seconds are tested
+        health_check_idle: float, optional
+            test idle connections only if they were not used for this number of seconds
+        server_type, database, user, password, port, host:
+            the connection parameters (same as connect_translator_db())
+        """
+        self.min_size = int(min_size)
+        self.max_size = int(max_size)
+        self.health_check = health_check
+        self.health_check_idle = health_check_idle
+        # the time each connection was last returned to the pool (for the health check)
+        self._last_used = {}
+        self.server_type = server_type
+        params = get_translator_db_params(server_type=server_type, database=database, user=user, password=password, port=port, host=host)
+        debug(2, 'creating connection pool (min %d, max %d) for database %s' % (self.min_size, self.max_size, params['database']))
+        try:
+            self._pool = psycopg2.pool.ThreadedConnectionPool(self.min_size, self.max_size, **params)
+        except psycopg2.DatabaseError as e:
+            msg = 'Cannot create connection pool for sequence translator database %s. Error %s' % (server_type, e)
+            debug(3, msg)
+            raise SystemError(msg)
+
+    def _is_healthy(self, con):
+        """
+        test if a pooled connection can still be used
+
+        Parameters
+        ----------
+        con: psycopg2 connection
+
+        Returns
+        -------
+        bool: True if the connection is usable, False if it should be discarded
+        """
+        if con.closed:
+            return False
+        status = con.get_transaction_status()
+        if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if not self.health_check:
+            return True
+        # a recently used idle connection is handed out without a query
+        if status == psycopg2.extensions.TRANSACTION_STATUS_IDLE and time.time() - self._last_used.get(con, 0) < self.health_check_idle:
+            return True
+        try:
+            cur = con.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            con.rollback()
+            return True
+        except psycopg2.Error as e:
+            debug(5, 'pooled connection failed health check: %s' % e)
+            return False
+
+    def get_connection(self):
+        """
+        borrow a connection from the pool. must be returned using return_connection() when done
+
+        Returns
+        -------
+        con : the psycopg database connection
+        cur : the psycopg database cursor (DictCursor)
+        """
+        # try once more with a new connection if the pooled connection is broken
+        for ctry in range(2):
+            try:
+                con = self._pool.getconn()
+            except psycopg2.Error as e:
+                msg = 'Cannot get connection to sequence translator database %s from pool. Error %s' % (self.server_type, e)
+                debug(3, msg)
+                raise SystemError(msg)
+            if self._is_healthy(con):
+                cur = con.cursor(cursor_factory=psycopg2.extras.DictCursor)
+                return con, cur
+            debug(5, 'discarding broken pooled connection')
+            self._last_used.pop(con, None)
+            self._pool.putconn(con, close=True)
+        msg = 'Cannot get a working connection to sequence translator database %s from pool' % self.server_type
+        debug(3, msg)
+        raise SystemError(msg)
+
+    def return_connection(self, con):
+        """
+        return a borrowed connection to the pool.
+        Any uncommitted transaction is rolled back so the next user gets a clean connection (no query is sent if the connection is idle)
+
+        Parameters
+        ----------
+        con: psycopg2 connection
+            the connection obtained from get_connection()
+        """
+        close = False
+        if con.closed:
+            close = True
+        elif con.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                con.rollback()
+            except psycopg2.Error as e:
+                debug(5, 'failed resetting pooled connection, discarding it: %s' % e)
+                close = True
+        if close:
+            self._last_used.pop(con, None)
+        else:
+            self._last_used[con] = time.time()
+        self._pool.putconn(con, close=close)
+
+    def close(self):
+        """
+        close all the connections in the pool
+        """
+        debug(2, 'closing connection pool')
+        self._pool.closeall()
+        self._last_used = {}
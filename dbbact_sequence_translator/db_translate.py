@@ -1,6 +1,33 @@
-import psycopg2
+from collections import defaultdict
+import gzip
 
-from .utils import debug
+import psycopg2
+import psycopg2.extras
+import psycopg2.extensions
+
+from .utils import debug, chunks
+from .seq_index import get_memory_index
+from .seq_pack import pack_sequence, packed_prefix_ranges, packed_startswith, PACKED_LENGTH_SQL
+from .seq_hash import prefix_hash, PREFIX_HASH_LENGTH
+
+# maximal number of sequences looked up in a single batch query
+FAST_LOOKUP_CHUNK_SIZE = 1000
+# maximal number of whole seq ids (i.e. SILVA ids) queried in a single ANY() query
+WHOLESEQ_ID_CHUNK_SIZE = 10000
+# number of sequences added to the NewSequencesTable in each add_sequences_to_queue() transaction
+QUEUE_INSERT_CHUNK_SIZE = 10000
+# number of rows fetched in each round trip when exporting sequences to a file
+EXPORT_BATCH_SIZE = 10000
+# number of NewSequencesTable rows claimed by the queue processor in each transaction
+QUEUE_BATCH_SIZE = 1000
+# number of new WholeSeqIDsTable rows handled in each SequenceToSequenceTable update transaction
+STS_UPDATE_BATCH_SIZE = 100000
+# advisory lock id for serializing the SequenceToSequenceTable updates
+STS_UPDATE_LOCK_ID = 52110
+# SQL condition for the packed column {0} starting with the query sequence q (using the get_packed_prefix_bounds() ranges q.lo, q.hi, q.esc_lo, q.esc_hi
+# and the query length q.len - the 2 bit range can also contain shorter sequences)
+PACKED_PREFIX_MATCH_SQL = ('(({0} >= q.lo AND {0} < q.hi AND ' + PACKED_LENGTH_SQL + ' >= q.len) '
+						   'OR ({0} >= q.esc_lo AND {0} < q.esc_hi))')
 
 
 def get_whole_seq_ids(con, cur, sequence, primer=None, exact=False):
@@ -33,19 +60,29 @@ def get_whole_seq_ids(con, cur, sequence, primer=None, exact=False):
 		# cur.execute('EXPLAIN ANALYZE SELECT * FROM SequenceIDsTable WHERE sequence LIKE %s', [sequence + '%%'])
 		# res = cur.fetchall()
 		# debug(5, res)
-		cur.execute('SELECT * FROM SequenceIDsTable WHERE sequence LIKE %s', [sequence + '%%'])
+		# the sequence is at least PREFIX_HASH_LENGTH long, so use the prefix hash index to get the candidates, and verify using the packed sequence
+		# each unique sequence is stored once (UniqueSequencesTable), and SequenceIDsTable maps it to all the matching whole seq ids
+		cur.execute('SELECT u.sequence_packed, s.*, a.wholeseqid FROM UniqueSequencesTable u JOIN SequenceIDsTable s ON s.seqkey = u.seqkey '
+					'JOIN WholeSeqAccessionsTable a ON a.wsid = s.wsid '
+					'WHERE u.prefix_hash=%s', [prefix_hash(sequence)])
 	else:
 		debug(1, 'looking for exact matches for sequence %s' % sequence)
-		cur.execute('SELECT * FROM SequenceIDsTable WHERE sequence=%s', [sequence])
+		cur.execute('SELECT u.sequence_packed, s.*, a.wholeseqid FROM UniqueSequencesTable u JOIN SequenceIDsTable s ON s.seqkey = u.seqkey '
+					'JOIN WholeSeqAccessionsTable a ON a.wsid = s.wsid '
+					'WHERE u.sequence_packed=%s', [pack_sequence(sequence)])
 
 	if cur.rowcount == 0:
 		debug(1, 'no matches found')
 		return '', []
 
-	debug(1, 'found %d matches' % cur.rowcount)
+	debug(1, 'found %d candidates' % cur.rowcount)
+	packed = pack_sequence(sequence)
 	seqids = []
 	res = cur.fetchall()
 	for cres in res:
+		# the prefix hash candidates can be sequences with the same prefix hash not starting with the sequence
+		if not packed_startswith(cres['sequence_packed'], packed):
+			continue
 		if primer is not None:
 			if cres['primer'] != primer:
 				continue
@@ -54,6 +91,27 @@ def get_whole_seq_ids(con, cur, sequence, primer=None, exact=False):
 	return '', seqids
 
 
+def get_packed_prefix_bounds(sequence):
+	'''Get the sequence_packed ranges containing all the sequences starting with sequence, for querying the sequence_packed index
+
+	Parameters
+	----------
+	sequence: str
+		the sequence prefix (acgt)
+
+	Returns
+	-------
+	lo, hi: bytes
+		the range of 2 bit packed values (empty range if the sequence contains non acgt characters)
+	esc_lo, esc_hi: bytes
+		the range of escaped packed values (for stored sequences containing non acgt characters)
+	'''
+	ranges = packed_prefix_ranges(sequence)
+	if len(ranges) == 1:
+		ranges.insert(0, (b'', b''))
+	return ranges[0][0], ranges[0][1], ranges[1][0], ranges[1][1]
+
+
 def get_seqs_from_db_id(con, cur, db_name, db_seq_id):
 	'''Get all sequences that match the db_seq_id supplied for silva/greengenes
 
@@ -81,7 +139,8 @@ def get_seqs_from_db_id(con, cur, db_name, db_seq_id):
 		debug(9, err)
 		return err, [], []
 	db_seq_id = db_seq_id.lower()
-	cur.execute("SELECT id,sequence FROM SequencesTable where id in (select distinct dbbactid from WholeSeqIDsTable where WholeSeqID=%s AND dbid=%s)", [db_seq_id, db_id])
+	cur.execute("SELECT id,sequence FROM SequencesTable where id in (select distinct w.dbbactid from WholeSeqIDsTable w JOIN WholeSeqAccessionsTable a ON a.wsid = w.wsid "
+				"where a.WholeSeqID=%s AND w.dbid=%s)", [db_seq_id, db_id])
 	seq_ids = []
 	sequences = []
 	res = cur.fetchall()
@@ -92,40 +151,70 @@ def get_seqs_from_db_id(con, cur, db_name, db_seq_id):
 	return '', seq_ids, sequences
 
 
-def SequencesWholeToFile(con, cur, fileName, dbid):
+def SequencesWholeToFile(con, cur, fileName, dbid, batch_size=EXPORT_BATCH_SIZE):
 	'''
 	Save list of sequences to file, this will be used later 'whole' ids script
+	Only the sequences with no WholeSeqIDsTable records for the database are saved.
+	The sequences are read using a server side cursor, so the client memory does not depend on the number of sequences.
+	If con is not in a transaction, the (read only) transaction opened for the export is rolled back when done.
+	Otherwise the caller's transaction is left open (and uncommitted changes are not lost - but on a database error it is aborted and
+	the caller needs to roll it back)
 
 	Parameters
 	----------
 	con,cur
-	fileName - output file name
+	fileName - output file name (gzip compressed if ending with .gz)
 	dbid - type of db (e.g. silva)
+	batch_size: int, optional
+		number of rows fetched from the database in each round trip
 
 	Returns
 	-------
-	error message
+	err: str
+		error message or empty string ('') if ok
+	seq_count: int
+		number of sequences saved
 	'''
 	debug(1, 'SequencesWholeToFile')
 
+	seq_count = 0
+	# roll back only the transaction opened by this function
+	own_transaction = con.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
 	try:
-		# cur.execute("SELECT id,sequence,ggid FROM sequencestable")
-		cur.execute("SELECT id,sequence,ggid FROM sequencestable where id not in (select distinct dbbactid from wholeseqidstable where dbid=%s)" % dbid)
-
-		seq_count = 0
-		with open(fileName, 'w') as fl:
-			for cres in cur:
+		if fileName.endswith('.gz'):
+			fl = gzip.open(fileName, 'wt')
+		else:
+			fl = open(fileName, 'w')
+	except OSError as e:
+		debug(7, 'cannot open output file %s: %s' % (fileName, e))
+		return 'cannot open output file %s: %s' % (fileName, e), seq_count
+	try:
+		with fl, con.cursor(name='sequences_whole_to_file') as read_cur:
+			read_cur.itersize = batch_size
+			read_cur.execute('SELECT s.id, s.sequence FROM SequencesTable s '
+							'WHERE NOT EXISTS (SELECT 1 FROM WholeSeqIDsTable w WHERE w.dbbactid = s.id AND w.dbid = %s)', [dbid])
+			for cres in read_cur:
 				fl.write('>%s\n%s\n' % (cres[0], cres[1]))
 				seq_count += 1
+		if own_transaction:
+			con.rollback()
 	except psycopg2.DatabaseError as e:
+		if own_transaction:
+			con.rollback()
 		debug(7, 'database error %s' % e)
-		return "database error %s" % e
-	return ''
+		return "database error %s" % e, seq_count
+	except OSError as e:
+		if own_transaction:
+			con.rollback()
+		debug(7, 'cannot write output file %s: %s' % (fileName, e))
+		return 'cannot write output file %s: %s' % (fileName, e), seq_count
+	debug(2, 'saved %d sequences to %s' % (seq_count, fileName))
+	return '', seq_count
 
 
 def add_whole_seq_id(con, cur, dbidVal, dbbactidVal, wholeseqidVal, commit=True, test_exists=True):
 	'''
-	Add record to WholeSeqIDsTable table
+	Add record to WholeSeqIDsTable table (if not already there)
 
 	Parameters
 	----------
@@ -139,24 +228,52 @@ def add_whole_seq_id(con, cur, dbidVal, dbbactidVal, wholeseqidVal, commit=True,
 	commit: bool, optional
 		true to commit, false to insert without commit
 	test_exists: bool, optional
-		if True, check if sequence exists before adding.
-		if False, skip the check (when populating an empty database - for speed)
+		not used (kept for compatibility). existing records are skipped using the WholeSeqIDsTable unique index.
+		for adding many records, use add_whole_seq_ids()
 
 	Returns
 	-------
 	str: error message or empty string ('') if ok
 	'''
 	debug(1, 'add_whole_seq_id')
+	return add_whole_seq_ids(con, cur, [(dbidVal, dbbactidVal, wholeseqidVal)], commit=commit)
+
+
+def add_whole_seq_ids(con, cur, whole_seq_ids, commit=True, chunk_size=WHOLESEQ_ID_CHUNK_SIZE):
+	'''Add records to the WholeSeqIDsTable table. Records already in the table are skipped (using the unique index and ON CONFLICT DO NOTHING),
+	so concurrent processes can add the same records
+
+	Parameters
+	----------
+	con,cur
+	whole_seq_ids: list (or iterable) of (int, int, str)
+		the (whole seq db id, dbbact sequence id, whole seq id (i.e. silva id)) of each record to add
+	commit: bool, optional
+		true to commit after each chunk, false to insert without commit
+	chunk_size: int, optional
+		number of records added in each INSERT (and transaction if commit is True)
+
+	Returns
+	-------
+	str: error message or empty string ('') if ok
+	'''
+	whole_seq_ids = list(whole_seq_ids)
 	try:
-		existFlag = False
-		if test_exists:
-			# check if we already have this entry
-			err, existFlag = test_whole_seq_id_exists(con, cur, dbidVal, dbbactidVal, wholeseqidVal)
-		if not existFlag:
-			cur.execute('INSERT INTO wholeseqidstable (dbid, dbbactid, wholeseqid) VALUES (%s, %s, %s)', [dbidVal, dbbactidVal, wholeseqidVal])
+		num_added = 0
+		for cchunk in chunks(whole_seq_ids, chunk_size):
+			dbids, dbbact_ids, wholeseqids = zip(*cchunk)
+			err = add_whole_seq_accessions(con, cur, wholeseqids, commit=False)
+			if err:
+				return err
+			cur.execute('INSERT INTO WholeSeqIDsTable (dbid, dbbactid, wsid) '
+						'SELECT q.dbid, q.dbbactid, a.wsid FROM unnest(%s::int[], %s::int[], %s::text[]) AS q(dbid, dbbactid, wholeseqid) '
+						'JOIN WholeSeqAccessionsTable a ON a.wholeseqid = lower(q.wholeseqid) '
+						'ON CONFLICT DO NOTHING', [list(dbids), list(dbbact_ids), list(wholeseqids)])
+			num_added += cur.rowcount
 			if commit:
 				con.commit()
-		return
+		debug(2, 'added %d whole seq ids (%d already exist)' % (num_added, len(whole_seq_ids) - num_added))
+		return ''
 	except psycopg2.DatabaseError as e:
 		debug(7, 'database error %s' % e)
 		return "database error %s" % e
@@ -184,7 +301,8 @@ def test_whole_seq_id_exists(con, cur, dbidVal, dbbactidVal, wholeseqidVal=None)
 
 	try:
 		if wholeseqidVal is not None:
-			cur.execute("SELECT * FROM WholeSeqIDsTable where dbID = %s and dbbactID = %s and WholeSeqID = %s", [dbidVal, dbbactidVal, wholeseqidVal])
+			cur.execute("SELECT w.* FROM WholeSeqIDsTable w JOIN WholeSeqAccessionsTable a ON a.wsid = w.wsid "
+						"where w.dbID = %s and w.dbbactID = %s and a.WholeSeqID = %s", [dbidVal, dbbactidVal, wholeseqidVal.lower()])
 		else:
 			cur.execute("SELECT * FROM WholeSeqIDsTable where dbID = %s and dbbactID = %s", [dbidVal, dbbactidVal])
 		if cur.rowcount > 0:
@@ -197,6 +315,34 @@ def test_whole_seq_id_exists(con, cur, dbidVal, dbbactidVal, wholeseqidVal=None)
 		return "database error %s" % e, False
 
 
+def add_whole_seq_accessions(con, cur, whole_seq_ids, commit=True):
+	'''Add whole seq ids (accessions) to the WholeSeqAccessionsTable (if not already there)
+	The other tables store the integer id (wsid) of the whole seq id from this table
+
+	Parameters
+	----------
+	con, cur
+	whole_seq_ids: list of str
+		the whole seq ids to add (i.e. 'jq782411' for silva)
+	commit: bool, optional
+		true to commit, false to insert without commit
+
+	Returns
+	-------
+	str: error message or empty string ('') if ok
+	'''
+	try:
+		cur.execute('INSERT INTO WholeSeqAccessionsTable (wholeseqid) SELECT DISTINCT lower(x) FROM unnest(%s::text[]) AS x '
+					'WHERE NOT EXISTS (SELECT 1 FROM WholeSeqAccessionsTable a WHERE a.wholeseqid = lower(x)) ON CONFLICT DO NOTHING', [list(whole_seq_ids)])
+		debug(1, 'added %d new whole seq accessions' % cur.rowcount)
+		if commit:
+			con.commit()
+		return ''
+	except psycopg2.DatabaseError as e:
+		debug(7, 'database error %s' % e)
+		return "database error %s" % e
+
+
 def get_dbbact_ids_from_wholeseq_ids(con, cur, whole_seq_ids, whole_seq_db_name=None, whole_seq_db_version=None):
 	'''Get all sequences that match the db_seq_id supplied for silva/greengenes
 
@@ -226,18 +372,19 @@ def get_dbbact_ids_from_wholeseq_ids(con, cur, whole_seq_ids, whole_seq_db_name=
 	else:
 		whole_seq_db_id = None
 	try:
-		dbids = []
-		for cseq in whole_seq_ids:
-			cids = set()
-			cseq = cseq.lower()
+		whole_seq_ids = [x.lower() for x in whole_seq_ids]
+		# get the dbbact ids for all the whole seq ids using one query per chunk, and group by whole seq id
+		id_map = defaultdict(set)
+		for cids in chunks(list(set(whole_seq_ids)), WHOLESEQ_ID_CHUNK_SIZE):
 			if whole_seq_db_id is None:
-				cur.execute('SELECT dbbactID FROM WholeSeqIDsTable WHERE WholeSeqID=%s', [cseq])
+				cur.execute('SELECT a.WholeSeqID, w.dbbactID FROM WholeSeqAccessionsTable a JOIN WholeSeqIDsTable w ON w.wsid = a.wsid '
+							'WHERE a.WholeSeqID = ANY(%s)', [cids])
 			else:
-				cur.execute('SELECT dbbactID FROM WholeSeqIDsTable WHERE WholeSeqID=%s AND dbid=%s', [cseq, whole_seq_db_id])
-			res = cur.fetchall()
-			for cres in res:
-				cids.add(cres['dbbactid'])
-			dbids.append(list(cids))
+				cur.execute('SELECT a.WholeSeqID, w.dbbactID FROM WholeSeqAccessionsTable a JOIN WholeSeqIDsTable w ON w.wsid = a.wsid '
+							'WHERE a.WholeSeqID = ANY(%s) AND w.dbid=%s', [cids, whole_seq_db_id])
+			for cres in cur.fetchall():
+				id_map[cres['wholeseqid']].add(cres['dbbactid'])
+		dbids = [list(id_map.get(cseq, [])) for cseq in whole_seq_ids]
 		return '', dbids
 	except Exception as e:
 		msg = 'error encountered when getting dbbact ids from whole seq ids: %s' % e
@@ -279,16 +426,19 @@ def get_whole_seq_db_id_from_name(con, cur, whole_seq_db_name, whole_seq_db_vers
 		return msg, None
 
 
-def add_sequences_to_queue(con, cur, seq_info, commit=True):
+def add_sequences_to_queue(con, cur, seq_info, commit=True, chunk_size=QUEUE_INSERT_CHUNK_SIZE):
 	'''Add sequences to the waiting for processing table.
-	These sequences will be added daily to the wholeseqids table using the dbbact-server/dbbact_jobs/update_whole_seq_db.py
+	These sequences are added to the wholeseqids table by process_queue_batch() (using scripts/process_sequences_queue.py)
+	Sequences already waiting in the queue (same dbbactid) are skipped, so adding the same sequences again does not create duplicate work
 
 	Parameters
 	----------
 	con, cur
 	seq_info: dict of {dbbactid(int): sequences(str)}
 	commit: bool, optional
-		true to commit, false to insert without commit
+		true to commit after each chunk, false to insert without commit
+	chunk_size: int, optional
+		number of sequences inserted in each INSERT (and transaction if commit is True)
 
 	Returns
 	-------
@@ -296,46 +446,236 @@ def add_sequences_to_queue(con, cur, seq_info, commit=True):
 	'''
 	debug(3, 'add_sequences_to_queue for %d sequences' % len(seq_info))
 	try:
-		for cid, cseq in seq_info.items():
-			cseq = cseq.lower()
-			cur.execute('INSERT INTO NewSequencesTable (dbbactID, sequence) VALUES (%s, %s)', [cid, cseq])
-		debug(3, 'added %d sequences' % len(seq_info))
-		if commit:
-			con.commit()
+		num_added = 0
+		for cchunk in chunks(list(seq_info.items()), chunk_size):
+			values = []
+			for cid, cseq in cchunk:
+				cseq = cseq.lower()
+				values.append((str(cid), cseq, pack_sequence(cseq), prefix_hash(cseq)))
+			res = psycopg2.extras.execute_values(cur, 'INSERT INTO NewSequencesTable (dbbactID, sequence, sequence_packed, prefix_hash) VALUES %s '
+												'ON CONFLICT (dbbactID) DO NOTHING RETURNING 1', values, page_size=len(values), fetch=True)
+			num_added += len(res)
+			if commit:
+				con.commit()
+		debug(3, 'added %d sequences (%d already in queue)' % (num_added, len(seq_info) - num_added))
 		return ''
 	except Exception as e:
-		debug(6, 'error enountered when adding sequences to queue: %s' % e)
-		return e
+		if commit:
+			con.rollback()
+		msg = 'error enountered when adding sequences to queue: %s' % e
+		debug(6, msg)
+		return msg
+
+
+def process_queue_batch(con, cur, dbid, batch_size=QUEUE_BATCH_SIZE):
+	'''Process a batch of sequences waiting in the NewSequencesTable queue (added by add_sequences_to_queue()).
+	The batch rows are claimed and removed from the queue using DELETE ... FOR UPDATE SKIP LOCKED (so several processes can work on the queue
+	concurrently), matched to the whole seq ids of all the region sequences starting with them and added to WholeSeqIDsTable
+	(in a single transaction, so the rows are back in the queue if the processing fails).
+
+	Parameters
+	----------
+	con, cur
+	dbid: int
+		the whole seq database id (from get_whole_seq_db_id_from_name()) for the new WholeSeqIDsTable rows
+	batch_size: int, optional
+		maximal number of queued sequences to process
+
+	Returns
+	-------
+	err: str
+		empty ('') if ok, otherwise the error encountered
+	num_processed: int
+		number of queued sequences processed (0 if the queue is empty or all rows are claimed by other processes)
+	num_added: int
+		number of rows added to WholeSeqIDsTable
+	'''
+	try:
+		# the dbbactid is unique in the queue (see upgrade 007)
+		cur.execute('DELETE FROM NewSequencesTable WHERE dbbactid IN (SELECT dbbactid FROM NewSequencesTable LIMIT %s FOR UPDATE SKIP LOCKED) '
+					'RETURNING dbbactid, sequence', [batch_size])
+		res = cur.fetchall()
+		if len(res) == 0:
+			con.commit()
+			return '', 0, 0
+		dbbact_ids = [int(cres['dbbactid']) for cres in res]
+		seqs = [cres['sequence'].lower() for cres in res]
+		num_added = _add_whole_seq_ids_for_sequences(cur, dbid, dbbact_ids, seqs)
+		con.commit()
+		debug(2, 'processed %d queued sequences, added %d whole seq ids' % (len(res), num_added))
+		return '', len(res), num_added
+	except psycopg2.DatabaseError as e:
+		con.rollback()
+		msg = 'database error %s encountered when processing sequences queue' % e
+		debug(7, msg)
+		return msg, 0, 0
+
+
+def _add_whole_seq_ids_for_sequences(cur, dbid, dbbact_ids, seqs):
+	'''Add the WholeSeqIDsTable rows for dbbact sequences, using set based prefix joins with the UniqueSequencesTable (not committed)
+
+	Parameters
+	----------
+	cur
+	dbid: int
+		the whole seq database id
+	dbbact_ids: list of int
+		the dbbact id of each sequence
+	seqs: list of str
+		the dbbact sequences (lowercase acgt)
+
+	Returns
+	-------
+	int: number of rows added
+	'''
+	num_added = 0
+	# sequences at least PREFIX_HASH_LENGTH long are matched using the prefix hash index, shorter ones using the sequence_packed index.
+	# the candidates are verified using the packed sequence (PACKED_PREFIX_MATCH_SQL)
+	long_pos = [pos for pos, cseq in enumerate(seqs) if len(cseq) >= PREFIX_HASH_LENGTH]
+	short_pos = [pos for pos, cseq in enumerate(seqs) if len(cseq) < PREFIX_HASH_LENGTH]
+	if len(long_pos) > 0:
+		bounds = [get_packed_prefix_bounds(seqs[x]) for x in long_pos]
+		cur.execute('INSERT INTO WholeSeqIDsTable (dbid, dbbactid, wsid) '
+					'SELECT DISTINCT %s, q.dbbactid, s.wsid FROM unnest(%s::bigint[], %s::bytea[], %s::bytea[], %s::bytea[], %s::bytea[], %s::int[], %s::int[]) AS q(prefix_hash, lo, hi, esc_lo, esc_hi, len, dbbactid) '
+					'JOIN UniqueSequencesTable u ON u.prefix_hash = q.prefix_hash AND ' + PACKED_PREFIX_MATCH_SQL.format('u.sequence_packed') + ' '
+					'JOIN SequenceIDsTable s ON s.seqkey = u.seqkey '
+					'ON CONFLICT DO NOTHING',
+					[dbid, [prefix_hash(seqs[x]) for x in long_pos]] + [list(x) for x in zip(*bounds)] + [[len(seqs[x]) for x in long_pos], [dbbact_ids[x] for x in long_pos]])
+		num_added += cur.rowcount
+	if len(short_pos) > 0:
+		bounds = [get_packed_prefix_bounds(seqs[x]) for x in short_pos]
+		cur.execute('INSERT INTO WholeSeqIDsTable (dbid, dbbactid, wsid) '
+					'SELECT DISTINCT %s, q.dbbactid, s.wsid FROM unnest(%s::bytea[], %s::bytea[], %s::bytea[], %s::bytea[], %s::int[], %s::int[]) AS q(lo, hi, esc_lo, esc_hi, len, dbbactid) '
+					'JOIN LATERAL (SELECT seqkey FROM UniqueSequencesTable '
+					'WHERE ' + PACKED_PREFIX_MATCH_SQL.format('sequence_packed') + ') u ON true '
+					'JOIN SequenceIDsTable s ON s.seqkey = u.seqkey '
+					'ON CONFLICT DO NOTHING',
+					[dbid] + [list(x) for x in zip(*bounds)] + [[len(seqs[x]) for x in short_pos], [dbbact_ids[x] for x in short_pos]])
+		num_added += cur.rowcount
+	return num_added
+
+
+def update_sequence_to_sequence(con, cur, batch_size=STS_UPDATE_BATCH_SIZE):
+	'''Update the SequenceToSequenceTable for the WholeSeqIDsTable rows added since the last update (i.e. by process_queue_batch()).
+	Only the region sequences sharing a whole seq id with the new rows are recomputed (the dbbact ids of all the WholeSeqIDsTable rows
+	of all the whole seq ids of the region sequence), and updated/inserted into the SequenceToSequenceTable.
+	The new rows are handled in batches (by WholeSeqIDsTable id), and the last handled id is stored in SequenceToSequenceStateTable
+	after each batch, so an interrupted update continues from the last batch.
+	The rows are upserted using the unique sequence_packed index (see upgrade 009), so the sequence_packed column must be filled
+	(see backfill_sequence_columns.py).
+	NOTE: should run after the queue processing is done (rows committed later with a lower id are not included)
 
+	Parameters
+	----------
+	con, cur
+	batch_size: int, optional
+		number of new WholeSeqIDsTable rows handled in each transaction
 
-def get_dbbact_ids_from_wholeseq_ids_fast(con, cur, seqs):
+	Returns
+	-------
+	err: str
+		empty ('') if ok, otherwise the error encountered
+	num_updated: int
+		number of SequenceToSequenceTable region sequences updated or added
+	'''
+	num_updated = 0
+	try:
+		# rows with no sequence_packed cannot be matched to the existing rows (and would be added again on each update)
+		for ctable in ['UniqueSequencesTable', 'SequenceToSequenceTable']:
+			cur.execute('SELECT EXISTS (SELECT 1 FROM %s WHERE sequence_packed IS NULL) AS missing' % ctable)
+			if cur.fetchone()['missing']:
+				con.rollback()
+				msg = '%s rows have no sequence_packed. run backfill_sequence_columns.py --packed first' % ctable
+				debug(7, msg)
+				return msg, 0
+		cur.execute('SELECT max(id) AS max_id FROM WholeSeqIDsTable')
+		max_id = cur.fetchone()['max_id'] or 0
+		while True:
+			# only one update at a time
+			cur.execute('SELECT pg_advisory_xact_lock(%s)', [STS_UPDATE_LOCK_ID])
+			cur.execute('SELECT last_wholeseqids_id FROM SequenceToSequenceStateTable')
+			last_id = cur.fetchone()['last_wholeseqids_id']
+			if last_id >= max_id:
+				con.commit()
+				break
+			end_id = min(last_id + batch_size, max_id)
+			debug(2, 'updating SequenceToSequenceTable for WholeSeqIDsTable ids %d-%d' % (last_id + 1, end_id))
+			# the region sequences sharing a whole seq id with the new rows
+			cur.execute('CREATE TEMP TABLE sts_keys ON COMMIT DROP AS SELECT DISTINCT s.seqkey FROM WholeSeqIDsTable w '
+						'JOIN SequenceIDsTable s ON s.wsid = w.wsid WHERE w.id > %s AND w.id <= %s', [last_id, end_id])
+			# the dbbact ids of all the whole seq ids of each such region sequence
+			cur.execute('CREATE TEMP TABLE sts_new ON COMMIT DROP AS '
+						'SELECT u.sequence, u.sequence_packed, u.prefix_hash, array_agg(DISTINCT w.dbbactid ORDER BY w.dbbactid) AS dbbactids '
+						'FROM sts_keys k JOIN UniqueSequencesTable u ON u.seqkey = k.seqkey '
+						'JOIN SequenceIDsTable s ON s.seqkey = k.seqkey JOIN WholeSeqIDsTable w ON w.wsid = s.wsid '
+						'GROUP BY u.seqkey, u.sequence, u.sequence_packed, u.prefix_hash')
+			cur.execute('INSERT INTO SequenceToSequenceTable (sequence, sequence_packed, prefix_hash, dbbactids) '
+						'SELECT n.sequence, n.sequence_packed, n.prefix_hash, n.dbbactids FROM sts_new n '
+						'ON CONFLICT (sequence_packed) DO UPDATE SET dbbactids = EXCLUDED.dbbactids')
+			num_batch = cur.rowcount
+			cur.execute('UPDATE SequenceToSequenceStateTable SET last_wholeseqids_id = %s', [end_id])
+			con.commit()
+			num_updated += num_batch
+			debug(2, 'updated %d region sequences' % num_batch)
+		debug(3, 'SequenceToSequenceTable update done. updated %d region sequences' % num_updated)
+		return '', num_updated
+	except psycopg2.DatabaseError as e:
+		con.rollback()
+		msg = 'database error %s encountered when updating SequenceToSequenceTable' % e
+		debug(7, msg)
+		return msg, num_updated
+
+
+def get_dbbact_ids_from_wholeseq_ids_fast(con, cur, seqs, chunk_size=FAST_LOOKUP_CHUNK_SIZE):
 	'''Get dbbact ids for sequences on all regions by using wholeseq databases (SILVA.GreenGenes/etc).
 	This is a fast function using the SequenceToSequence Table which is precomputed.
+	If the in-memory sequence index is enabled (seq_index.set_memory_index()), it is used instead of the database.
+	Otherwise, all the sequences in a chunk are looked up together (instead of one query per sequence)
 
 	Parameters
 	----------
 	con, cur
 	seqs: list of str
 		The sequences to find
+	chunk_size: int, optional
+		maximal number of sequences to look up in each query
 
 	Returns
 	-------
 	list of list of int:
 		the matching dbbact ids for each input sequence
 	'''
+	# if the in-memory index is enabled, use it instead of the database
+	index = get_memory_index()
+	if index is not None:
+		return '', index.lookup_many(seqs)
+
 	all_seq_ids = []
-	cur.execute('PREPARE translate_ids(text) AS SELECT dbbactIDs FROM SequenceToSequenceTable WHERE sequence LIKE $1 LIMIT 1')
-	for cseq in seqs:
-		cseq = cseq.lower()
-		cur.execute('EXECUTE translate_ids(%s)', [cseq + '%%'])
-		# cur.execute('SELECT dbbactIDs FROM SequenceToSequenceTable WHERE sequence LIKE %s LIMIT 1', [cseq + '%%'])
-		if cur.rowcount == 0:
-			ids = []
-		else:
-			res = cur.fetchone()
-			ids_str = res['dbbactids']
-			ids = [int(x) for x in ids_str.split(',')]
-		all_seq_ids.append(ids)
+	for cseqs in chunks(seqs, chunk_size):
+		cseqs = [x.lower() for x in cseqs]
+		chunk_ids = [[] for x in cseqs]
+		# sequences at least PREFIX_HASH_LENGTH long are looked up using the prefix hash index, shorter ones using the sequence_packed index.
+		# the candidates are verified using the packed sequence (PACKED_PREFIX_MATCH_SQL)
+		long_pos = [pos for pos, cseq in enumerate(cseqs) if len(cseq) >= PREFIX_HASH_LENGTH]
+		short_pos = [pos for pos, cseq in enumerate(cseqs) if len(cseq) < PREFIX_HASH_LENGTH]
+		if len(long_pos) > 0:
+			bounds = [get_packed_prefix_bounds(cseqs[x]) for x in long_pos]
+			cur.execute("SELECT q.pos, s.dbbactids FROM unnest(%s::bigint[], %s::bytea[], %s::bytea[], %s::bytea[], %s::bytea[], %s::int[], %s::int[]) AS q(prefix_hash, lo, hi, esc_lo, esc_hi, len, pos) "
+						"JOIN LATERAL (SELECT dbbactIDs FROM SequenceToSequenceTable "
+						"WHERE prefix_hash = q.prefix_hash AND " + PACKED_PREFIX_MATCH_SQL.format('sequence_packed') + " LIMIT 1) s ON true",
+						[[prefix_hash(cseqs[x]) for x in long_pos]] + [list(x) for x in zip(*bounds)] + [[len(cseqs[x]) for x in long_pos], long_pos])
+			for cres in cur.fetchall():
+				chunk_ids[cres['pos']] = cres['dbbactids'] or []
+		if len(short_pos) > 0:
+			bounds = [get_packed_prefix_bounds(cseqs[x]) for x in short_pos]
+			cur.execute("SELECT q.pos, s.dbbactids FROM unnest(%s::bytea[], %s::bytea[], %s::bytea[], %s::bytea[], %s::int[], %s::int[]) AS q(lo, hi, esc_lo, esc_hi, len, pos) "
+						"JOIN LATERAL (SELECT dbbactIDs FROM SequenceToSequenceTable "
+						"WHERE " + PACKED_PREFIX_MATCH_SQL.format('sequence_packed') + " LIMIT 1) s ON true",
+						[list(x) for x in zip(*bounds)] + [[len(cseqs[x]) for x in short_pos], short_pos])
+			for cres in cur.fetchall():
+				chunk_ids[cres['pos']] = cres['dbbactids'] or []
+		all_seq_ids.extend(chunk_ids)
+	debug(1, 'looked up %d sequences' % len(all_seq_ids))
 	return '', all_seq_ids
 
 
@@ -371,27 +711,25 @@ def get_whole_seq_names(con, cur, whole_seq_ids, dbid=1, only_species=True, max_
 	fullnames = []
 	species = []
 	ids = []
+	whole_seq_ids = [x.lower() for x in whole_seq_ids]
+	if max_num > 0:
+		limit = max_num
+	else:
+		# LIMIT NULL is the same as no limit
+		limit = None
 	try:
-		for cseq in whole_seq_ids:
-			cseq = cseq.lower()
-			if dbid > 0:
-				cur.execute('SELECT name, fullname, species FROM wholeseqnamestable WHERE wholeseqid=%s AND dbid=%s LIMIT 1', [cseq, dbid])
-			else:
-				cur.execute('SELECT name, fullname, species FROM wholeseqnamestable WHERE wholeseqid=%s LIMIT 1', [cseq])
-			if cur.rowcount == 0:
-				continue
-			res = cur.fetchone()
-			if only_species:
-				if res['species'] == '':
-					continue
-			names.append(res['name'])
-			fullnames.append(res['fullname'])
-			species.append(res['species'])
-			ids.append(cseq)
-			# do we have enough results?
-			if max_num > 0:
-				if len(ids) >= max_num:
-					break
+		# take one name per whole seq id, keep the input order and apply the species filter and the limit
+		cur.execute('SELECT q.wholeseqid, n.name, n.fullname, n.species FROM unnest(%s::text[]) WITH ORDINALITY AS q(wholeseqid, pos) '
+					'JOIN WholeSeqAccessionsTable a ON a.wholeseqid = q.wholeseqid '
+					'JOIN LATERAL (SELECT name, fullname, species FROM wholeseqnamestable '
+					'WHERE wsid = a.wsid AND (%s <= 0 OR dbid = %s) LIMIT 1) n ON true '
+					"WHERE NOT %s OR n.species != '' "
+					'ORDER BY q.pos LIMIT %s', [whole_seq_ids, dbid, dbid, only_species, limit])
+		for cres in cur.fetchall():
+			names.append(cres['name'])
+			fullnames.append(cres['fullname'])
+			species.append(cres['species'])
+			ids.append(cres['wholeseqid'])
 		return '', names, fullnames, species, ids
 	except Exception as e:
 		msg = "error %s encountered for get_whole_seq_names for ids %s" % (e, whole_seq_ids)
@@ -420,25 +758,15 @@ def get_species_seqs(con, cur, species, dbid=1):
 	'''
 	species = species.lower()
 	try:
+		# get the dbbact ids of all the whole seq ids matching the species (joined using the integer whole seq ids)
 		if dbid > 0:
-			cur.execute("SELECT wholeseqid FROM wholeseqnamestable WHERE search_name LIKE %s AND dbid=%s", [species+'%%', dbid])
-			# cur.execute('SELECT wholeseqid FROM wholeseqnamestable WHERE species=%s AND dbid=%s', [species, dbid])
+			cur.execute("SELECT DISTINCT w.dbbactid FROM wholeseqnamestable n JOIN WholeSeqIDsTable w ON w.wsid = n.wsid "
+						"WHERE n.search_name LIKE %s AND n.dbid=%s", [species+'%%', dbid])
 		else:
-			# cur.execute('SELECT wholeseqid FROM wholeseqnamestable WHERE species=%s', [species])
-			cur.execute("SELECT wholeseqid FROM wholeseqnamestable WHERE search_name LIKE %s", [species+'%%'])
-		res = cur.fetchall()
-		debug(2, 'found %d wholeseq ids matching the species %s' % (len(res), species))
-		wsids = []
-		for cres in res:
-			wsids.append(cres['wholeseqid'])
-
-		debug(2, 'Getting dbbact ids from %d wholeseq ids' % len(wsids))
-		err, ids = get_dbbact_ids_from_wholeseq_ids(con, cur, wsids)
-		if err:
-			return err, []
-		ids = [item for sublist in ids for item in sublist]
-		ids = list(set(ids))
-		debug(2, 'Got %d dbbact ids' % len(ids))
+			cur.execute("SELECT DISTINCT w.dbbactid FROM wholeseqnamestable n JOIN WholeSeqIDsTable w ON w.wsid = n.wsid "
+						"WHERE n.search_name LIKE %s", [species+'%%'])
+		ids = [cres['dbbactid'] for cres in cur.fetchall()]
+		debug(2, 'Got %d dbbact ids for species %s' % (len(ids), species))
 		return '', ids
 	except Exception as e:
 		msg = "error %s encountered for get_species_seqs for species %s" % (e, species)
@@ -0,0 +1,66 @@
+import gzip
+
+# size of the read buffer for the fasta files
+READ_BUFFER_SIZE = 16 * 1024 * 1024
+
+_UPPER = b'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+_LOWER = b'abcdefghijklmnopqrstuvwxyz'
+# sequence translation tables (convert case and U to T)
+_TRANSLATE_TABLES = {'lower': bytes.maketrans(_UPPER + b'u', _LOWER.replace(b'u', b't') + b't'),
+                     'upper': bytes.maketrans(_LOWER + b'U', _UPPER.replace(b'U', b'T') + b'T'),
+                     None: bytes.maketrans(b'uU', b'tT')}
+# characters removed from the sequences
+_DELETE_CHARS = b' \t\r\n'
+
+
+def open_fasta(filename):
+    '''Open a fasta file for binary reading (gzip compressed if the file name ends with .gz)
+
+    Parameters
+    ----------
+    filename: str
+        name of the fasta file
+
+    Returns
+    -------
+    binary file object
+    '''
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb', buffering=READ_BUFFER_SIZE)
+
+
+def iter_fasta_seqs(filename, case='lower'):
+    '''Iterate over the records of a fasta file (can be .gz compressed)
+
+    Parameters
+    ----------
+    filename: str
+        the fasta file name
+    case: str or None, optional
+        'lower' to convert the sequences to lowercase
+        'upper' to convert the sequences to uppercase
+        None to keep the original case
+        In all cases, U is converted to T
+
+    Yields
+    ------
+    seq: str
+        the sequence
+    header: str
+        the header (without the '>')
+    '''
+    table = _TRANSLATE_TABLES[case]
+    with open_fasta(filename) as fl:
+        chead = None
+        lines = []
+        for cline in fl:
+            if cline[:1] == b'>':
+                if chead is not None:
+                    yield b''.join(lines).translate(table, _DELETE_CHARS).decode('ascii'), chead
+                chead = cline[1:].rstrip().decode()
+                lines = []
+            else:
+                lines.append(cline)
+        if chead is not None:
+            yield b''.join(lines).translate(table, _DELETE_CHARS).decode('ascii'), chead
@@ -1,6 +1,6 @@
 import json
 from flask import Blueprint, request, g
-from . import db_translate
+from . import db_translate, seq_index
 from .utils import debug, getdoc
 from .autodoc import auto
 
@@ -180,7 +180,12 @@ def f_get_dbbact_ids_from_unknown_seq_fast():
     if seq is None:
         return('sequences value missing', 400)
 
-    err, dbbact_ids = db_translate.get_dbbact_ids_from_wholeseq_ids_fast(g.con, g.cur, seq)
+    # use the in-memory index if enabled, so the request does not take a database connection (g.con is connected on first use)
+    index = seq_index.get_memory_index()
+    if index is not None:
+        err, dbbact_ids = '', index.lookup_many(seq)
+    else:
+        err, dbbact_ids = db_translate.get_dbbact_ids_from_wholeseq_ids_fast(g.con, g.cur, seq)
     if err:
         return(err, 400)
     if len(dbbact_ids) == 0:
@@ -0,0 +1,139 @@
+import os
+import mmap
+import struct
+
+from .utils import debug
+
+# the index file format:
+# header (HEADER_FORMAT): magic, version, sequence record width, number of records, position of the offsets table, position of the ids
+# sequences: number of records * record width bytes. each record is the sequence (ascii, lowercase) padded with \0. sorted
+# offsets table: (number of records + 1) int64 values. the dbbact ids of record i are ids[offsets[i]:offsets[i + 1]]
+# ids: int32 dbbact ids
+INDEX_MAGIC = b'DBBTIDX\0'
+INDEX_VERSION = 1
+HEADER_FORMAT = '<8sIIQQQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+
+def write_index_file(filename, seq_ids):
+    '''Write the sequence prefix index file used by MmapPrefixIndex.
+    The file is written to a temporary file and then renamed, so processes using the old file are not affected
+
+    Parameters
+    ----------
+    filename: str
+        name of the index file to create
+    seq_ids: list of (str, list of int)
+        the sequence (acgt) and matching dbbact ids for each SequenceToSequenceTable entry (any order)
+    '''
+    debug(2, 'writing index file %s for %d sequences' % (filename, len(seq_ids)))
+    seq_ids = [(cseq.lower().encode('ascii'), cids) for cseq, cids in seq_ids]
+    seq_ids.sort(key=lambda x: x[0])
+    seq_width = max([len(cseq) for cseq, cids in seq_ids], default=0)
+    num_records = len(seq_ids)
+    offsets_pos = HEADER_SIZE + num_records * seq_width
+    num_ids = sum([len(cids) for cseq, cids in seq_ids])
+    ids_pos = offsets_pos + (num_records + 1) * 8
+
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as fl:
+        fl.write(struct.pack(HEADER_FORMAT, INDEX_MAGIC, INDEX_VERSION, seq_width, num_records, offsets_pos, ids_pos))
+        for cseq, cids in seq_ids:
+            fl.write(cseq.ljust(seq_width, b'\0'))
+        offset = 0
+        fl.write(struct.pack('<q', offset))
+        for cseq, cids in seq_ids:
+            offset += len(cids)
+            fl.write(struct.pack('<q', offset))
+        for cseq, cids in seq_ids:
+            fl.write(struct.pack('<%di' % len(cids), *cids))
+    os.replace(tmp_filename, filename)
+    debug(2, 'wrote %d sequences, %d ids to index file %s' % (num_records, num_ids, filename))
+
+
+class MmapPrefixIndex:
+    '''Read only sequence prefix index stored in a file created by write_index_file().
+    The file is memory mapped, so all the processes using it (i.e. gunicorn workers) share the same memory (page cache).
+    Has the same lookup interface as seq_index.SequencePrefixIndex
+    '''
+    def __init__(self, filename):
+        '''Open the index file
+
+        Parameters
+        ----------
+        filename: str
+            name of the index file (created by write_index_file() / scripts/build_translation_index.py)
+        '''
+        self.filename = filename
+        with open(filename, 'rb') as fl:
+            self._mm = mmap.mmap(fl.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.seq_width, self.num_records, self.offsets_pos, self.ids_pos = struct.unpack_from(HEADER_FORMAT, self._mm, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError('file %s is not a sequence translator index file' % filename)
+        if version != INDEX_VERSION:
+            raise ValueError('index file %s version %d not supported (expected version %d)' % (filename, version, INDEX_VERSION))
+        debug(2, 'opened index file %s with %d sequences' % (filename, self.num_records))
+
+    def __len__(self):
+        return self.num_records
+
+    def _get_seq_prefix(self, pos, length):
+        '''Get the first length bytes of the record sequence in position pos'''
+        start = HEADER_SIZE + pos * self.seq_width
+        return self._mm[start:start + length]
+
+    def lookup(self, sequence):
+        '''Get the dbbact ids of the first indexed sequence starting with the query sequence
+
+        Parameters
+        ----------
+        sequence: str
+            the sequence to look for (acgt, lowercase)
+
+        Returns
+        -------
+        list of int
+            the dbbact ids for the matching sequence (empty list if no indexed sequence starts with sequence)
+        '''
+        try:
+            query = sequence.encode('ascii')
+        except UnicodeEncodeError:
+            # the indexed sequences are ascii, so a non ascii sequence has no matches
+            debug(2, 'non ascii sequence %r in index lookup' % sequence)
+            return []
+        qlen = len(query)
+        if qlen > self.seq_width:
+            return []
+        # binary search for the first record with prefix >= query
+        lo = 0
+        hi = self.num_records
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._get_seq_prefix(mid, qlen) < query:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.num_records:
+            return []
+        if self._get_seq_prefix(lo, qlen) != query:
+            return []
+        start, end = struct.unpack_from('<qq', self._mm, self.offsets_pos + lo * 8)
+        return list(struct.unpack_from('<%di' % (end - start), self._mm, self.ids_pos + start * 4))
+
+    def lookup_many(self, sequences):
+        '''Get the dbbact ids for each sequence in a list (same as calling lookup() for each sequence)
+
+        Parameters
+        ----------
+        sequences: list of str
+            the sequences to look for (acgt)
+
+        Returns
+        -------
+        list of list of int
+            the matching dbbact ids for each input sequence
+        '''
+        return [self.lookup(cseq.lower()) for cseq in sequences]
+
+    def close(self):
+        self._mm.close()
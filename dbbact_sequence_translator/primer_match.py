@@ -0,0 +1,145 @@
+'''Degenerate primer matching with mismatches, used for extracting the primer regions from the whole sequence database.
+
+The search is bit-parallel over the sequence positions: each primer position is converted to a bit mask of the sequence
+positions matching it (one byte per sequence position, created using bytes.translate and int.from_bytes), and the masks
+are combined using a shift-and (with mismatch counting) over python big ints. This way the per base work is done in C,
+and a match with up to max_mismatches mismatches is found in O(primer length * (max_mismatches + 1)) big int operations.
+Exact matches (max_mismatches=0) use a compiled regular expression, which is faster for this case.
+'''
+
+import re
+
+# the bases matching each IUPAC code
+IUPAC_CODES = {'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T', 'U': 'T',
+               'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT', 'K': 'GT', 'M': 'AC',
+               'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG', 'N': 'ACGT'}
+
+
+def parse_primer(primer):
+    '''Convert a primer to the list of matching bases for each primer position
+
+    Parameters
+    ----------
+    primer: str
+        the primer sequence. can contain IUPAC codes (i.e. 'GTGCCAGCMGCCGCGGTAA')
+        and/or regular expression style character classes (i.e. 'GTGCCAGC[AC]GCCGCGGTAA')
+
+    Returns
+    -------
+    list of str
+        the bases (uppercase) matching each primer position
+    '''
+    primer = primer.upper()
+    positions = []
+    pos = 0
+    while pos < len(primer):
+        cchar = primer[pos]
+        if cchar == '[':
+            end = primer.find(']', pos)
+            if end == -1:
+                raise ValueError('unmatched [ in primer %s' % primer)
+            cbases = ''.join([IUPAC_CODES[x] for x in primer[pos + 1:end]])
+            pos = end + 1
+        elif cchar in IUPAC_CODES:
+            cbases = IUPAC_CODES[cchar]
+            pos += 1
+        else:
+            raise ValueError('unsupported character %s in primer %s' % (cchar, primer))
+        positions.append(''.join(sorted(set(cbases))))
+    return positions
+
+
+def _class_chars(bases):
+    '''Get all the sequence characters matching a set of bases (upper and lowercase, and U for T)'''
+    if 'T' in bases:
+        bases += 'U'
+    return bases + bases.lower()
+
+
+class PrimerMatch:
+    '''The location of a primer match in a sequence (same interface as the re match start()/end())
+    '''
+    def __init__(self, start, end, mismatches):
+        self._start = start
+        self._end = end
+        self.mismatches = mismatches
+
+    def start(self):
+        return self._start
+
+    def end(self):
+        return self._end
+
+
+class PrimerMatcher:
+    '''Find the first occurrence of a degenerate primer in a sequence, allowing up to max_mismatches mismatches
+    '''
+    def __init__(self, primer, max_mismatches=0):
+        '''
+        Parameters
+        ----------
+        primer: str
+            the primer sequence (IUPAC codes and/or [] character classes)
+        max_mismatches: int, optional
+            maximal number of mismatching positions allowed in a match
+        '''
+        self.primer = primer
+        self.max_mismatches = max_mismatches
+        self.positions = parse_primer(primer)
+        self.length = len(self.positions)
+        # the exact match regular expression (also matching lowercase and U for T)
+        self._regex = re.compile(''.join(['[%s]' % _class_chars(cbases) for cbases in self.positions]))
+        # a translation table for each distinct primer position (bytes matching the position are converted to 1, all others to 0)
+        self._tables = {}
+        for cbases in set(self.positions):
+            table = bytearray(256)
+            for cbase in _class_chars(cbases):
+                table[ord(cbase)] = 1
+            self._tables[cbases] = bytes(table)
+
+    def search(self, sequence):
+        '''Find the first (leftmost) position where the primer matches the sequence with at most max_mismatches mismatches.
+        If several matches start at the same position, the one with the fewest mismatches is returned
+
+        Parameters
+        ----------
+        sequence: str
+            the sequence to search (acgt, any case)
+
+        Returns
+        -------
+        PrimerMatch or None if no match found
+        '''
+        if self.max_mismatches == 0:
+            match = self._regex.search(sequence)
+            if match is None:
+                return None
+            return PrimerMatch(match.start(), match.end(), 0)
+
+        num_positions = len(sequence) - self.length + 1
+        if num_positions <= 0:
+            return None
+        seq_bytes = sequence.encode('ascii')
+        # masks of the sequence positions matching each distinct primer position (8 bits per sequence position)
+        masks = {cbases: int.from_bytes(seq_bytes.translate(ctable), 'little') for cbases, ctable in self._tables.items()}
+        # bit 8*i is set for each possible match start position i
+        valid = int.from_bytes(b'\x01' * num_positions, 'little')
+        # found[d] contains the start positions with at most d mismatches so far
+        found = [valid] * (self.max_mismatches + 1)
+        for cpos, cbases in enumerate(self.positions):
+            cmatch = masks[cbases] >> (8 * cpos)
+            cmismatch = valid & ~cmatch
+            for cdist in range(self.max_mismatches, 0, -1):
+                found[cdist] = (found[cdist] & cmatch) | (found[cdist - 1] & cmismatch)
+            found[0] &= cmatch
+        if found[-1] == 0:
+            return None
+        best = found[-1]
+        start = ((best & -best).bit_length() - 1) // 8
+        # count the mismatches of the selected match
+        mismatches = 0
+        for cdist in range(self.max_mismatches + 1):
+            if (found[cdist] >> (8 * start)) & 1:
+                mismatches = cdist
+                break
+        return PrimerMatch(start, start + self.length, mismatches)
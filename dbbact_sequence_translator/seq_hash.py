@@ -0,0 +1,29 @@
+'''Hash of the sequence prefix, used for the prefix_hash bigint columns.
+All the sequence queries are at least PREFIX_HASH_LENGTH bp long, so the hash of the first PREFIX_HASH_LENGTH bases of the query
+can be used to get candidate matches using an exact (bigint) index lookup.
+The hash is the first 64 bits of the md5 of the prefix (as a signed bigint), so it can also be computed in SQL (PREFIX_HASH_SQL)
+'''
+
+import hashlib
+
+# number of bases used for the hash (the minimal query length)
+PREFIX_HASH_LENGTH = 100
+
+# SQL expression calculating the same hash as prefix_hash() for the sequence column
+PREFIX_HASH_SQL = "('x' || substr(md5(substr(lower(sequence), 1, %d)), 1, 16))::bit(64)::bigint" % PREFIX_HASH_LENGTH
+
+
+def prefix_hash(sequence):
+    '''Get the hash of the first PREFIX_HASH_LENGTH bases of the sequence
+
+    Parameters
+    ----------
+    sequence: str
+        the sequence (acgt)
+
+    Returns
+    -------
+    int: the 64 bit (signed) hash value
+    '''
+    prefix = sequence[:PREFIX_HASH_LENGTH].lower().encode('ascii')
+    return int.from_bytes(hashlib.md5(prefix).digest()[:8], 'big', signed=True)
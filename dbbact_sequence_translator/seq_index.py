@@ -0,0 +1,140 @@
+from array import array
+from bisect import bisect_left
+
+from .utils import debug
+from .seq_pack import unpack_sequence
+
+# the in-memory index used by the current process (None if not enabled)
+_memory_index = None
+
+
+class SequencePrefixIndex:
+    '''In-memory sorted index of the SequenceToSequenceTable, used to answer sequence prefix lookups
+    using binary search instead of querying the database.
+    The dbbact ids of all the sequences are stored in one flat int array (with an offsets array),
+    so the memory overhead is mostly the sequences themselves.
+    '''
+    def __init__(self, seq_ids):
+        '''Create the index from the sequences and their dbbact ids
+
+        Parameters
+        ----------
+        seq_ids: list of (str, list of int)
+            the sequence (acgt) and matching dbbact ids for each SequenceToSequenceTable entry (any order)
+        '''
+        seq_ids.sort(key=lambda x: x[0])
+        self.sequences = []
+        self.offsets = array('q', [0])
+        self.ids = array('q')
+        for cseq, cids in seq_ids:
+            self.sequences.append(cseq)
+            self.ids.extend(cids)
+            self.offsets.append(len(self.ids))
+        debug(2, 'created sequence prefix index with %d sequences, %d ids' % (len(self.sequences), len(self.ids)))
+
+    @classmethod
+    def load_from_db(cls, con, batch_size=10000):
+        '''Load the index from the SequenceToSequenceTable
+
+        Parameters
+        ----------
+        con: psycopg2 connection
+        batch_size: int, optional
+            number of rows to fetch from the database in each round trip
+
+        Returns
+        -------
+        SequencePrefixIndex
+        '''
+        debug(2, 'loading sequence prefix index from SequenceToSequenceTable')
+        return cls(read_sequence_to_sequence_table(con, batch_size=batch_size))
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def lookup(self, sequence):
+        '''Get the dbbact ids of the first indexed sequence starting with the query sequence
+
+        Parameters
+        ----------
+        sequence: str
+            the sequence to look for (acgt, lowercase)
+
+        Returns
+        -------
+        list of int
+            the dbbact ids for the matching sequence (empty list if no indexed sequence starts with sequence)
+        '''
+        pos = bisect_left(self.sequences, sequence)
+        if pos == len(self.sequences):
+            return []
+        if not self.sequences[pos].startswith(sequence):
+            return []
+        return list(self.ids[self.offsets[pos]:self.offsets[pos + 1]])
+
+    def lookup_many(self, sequences):
+        '''Get the dbbact ids for each sequence in a list (same as calling lookup() for each sequence)
+
+        Parameters
+        ----------
+        sequences: list of str
+            the sequences to look for (acgt)
+
+        Returns
+        -------
+        list of list of int
+            the matching dbbact ids for each input sequence
+        '''
+        return [self.lookup(cseq.lower()) for cseq in sequences]
+
+
+def read_sequence_to_sequence_table(con, batch_size=10000):
+    '''Read all the (sequence, dbbact ids) entries from the SequenceToSequenceTable
+    The sequences are read from the sequence_packed column (a quarter of the size of the text sequences)
+
+    Parameters
+    ----------
+    con: psycopg2 connection
+    batch_size: int, optional
+        number of rows to fetch from the database in each round trip
+
+    Returns
+    -------
+    list of (str, list of int)
+        the sequence (lowercase) and matching dbbact ids for each table entry
+    '''
+    seq_ids = []
+    # use a named (server side) cursor so we don't hold all the query results in memory twice
+    with con.cursor(name='read_sequence_to_sequence_table') as cur:
+        cur.itersize = batch_size
+        cur.execute('SELECT sequence_packed, dbbactIDs FROM SequenceToSequenceTable')
+        for cpacked, cids in cur:
+            if cpacked is None or cids is None:
+                continue
+            seq_ids.append((unpack_sequence(cpacked), cids))
+    con.rollback()
+    debug(2, 'read %d sequences from SequenceToSequenceTable' % len(seq_ids))
+    return seq_ids
+
+
+def set_memory_index(index):
+    '''Set the in-memory prefix index used by get_dbbact_ids_from_wholeseq_ids_fast() in this process
+
+    Parameters
+    ----------
+    index: SequencePrefixIndex or None
+        the index to use, or None to disable the index and use the database
+    '''
+    global _memory_index
+
+    _memory_index = index
+
+
+def get_memory_index():
+    '''Get the in-memory prefix index of this process
+
+    Returns
+    -------
+    SequencePrefixIndex or None if not enabled
+    '''
+    return _memory_index
@@ -0,0 +1,179 @@
+'''Packed (2 bits per base) representation of sequences, used for the sequence_packed bytea columns.
+
+Packed format:
+    acgt only sequences: PACKED_2BIT marker byte, 4 bases per byte (a=0, c=1, g=2, t=3, first base in the high bits,
+        last byte padded with a's), and a final byte with the number of padding bases (0-3)
+    sequences with other characters (ambiguous bases etc.): PACKED_ESCAPED marker byte followed by the lowercase ascii sequence
+In both formats, all sequences starting with a given sequence are in a contiguous range of byte values
+(see packed_prefix_ranges()), so a btree index on the packed column can be used for prefix lookups.
+The 2 bit range can also contain sequences shorter than the prefix (differing only in trailing a's), so the candidates are verified
+by also comparing the sequence length (packed_startswith(), or PACKED_LENGTH_SQL in the database queries).
+'''
+
+PACKED_2BIT = 0
+PACKED_ESCAPED = 1
+
+_BASE_TO_DIGIT = str.maketrans('acgt', '0123')
+_BYTE_TO_BASES = [''.join('acgt'[(cbyte >> cshift) & 3] for cshift in (6, 4, 2, 0)) for cbyte in range(256)]
+
+# SQL expression calculating the sequence length (number of bases) of a packed column (same as packed_length()). use PACKED_LENGTH_SQL.format(column)
+PACKED_LENGTH_SQL = ('(CASE WHEN get_byte({0}, 0) = %d THEN (octet_length({0}) - 2) * 4 - get_byte({0}, octet_length({0}) - 1) '
+                     'ELSE octet_length({0}) - 1 END)' % PACKED_2BIT)
+
+
+def _is_acgt(sequence):
+    # stripping stops at the first non acgt character, so anything left means the sequence is not acgt only
+    return sequence.strip('acgt') == ''
+
+
+def _pack_bases(sequence):
+    '''Pack an acgt sequence into bytes (4 bases per byte, last byte padded with a's)
+
+    Parameters
+    ----------
+    sequence: str
+        lowercase acgt only sequence
+
+    Returns
+    -------
+    bytes: the packed bases
+    int: number of padding bases in the last byte (0-3)
+    '''
+    num_pad = (-len(sequence)) % 4
+    if len(sequence) == 0:
+        return b'', 0
+    digits = sequence.translate(_BASE_TO_DIGIT) + '0' * num_pad
+    return int(digits, 4).to_bytes(len(digits) // 4, 'big'), num_pad
+
+
+def pack_sequence(sequence):
+    '''Convert a sequence to the packed format
+
+    Parameters
+    ----------
+    sequence: str
+        the sequence (acgt, can contain ambiguous bases)
+
+    Returns
+    -------
+    bytes: the packed sequence
+    '''
+    sequence = sequence.lower()
+    if not _is_acgt(sequence):
+        return bytes([PACKED_ESCAPED]) + sequence.encode('ascii')
+    body, num_pad = _pack_bases(sequence)
+    return bytes([PACKED_2BIT]) + body + bytes([num_pad])
+
+
+def unpack_sequence(packed):
+    '''Convert a packed sequence back to the (lowercase) sequence
+
+    Parameters
+    ----------
+    packed: bytes or memoryview
+        the packed sequence (from pack_sequence())
+
+    Returns
+    -------
+    str: the sequence
+    '''
+    packed = bytes(packed)
+    if packed[0] == PACKED_ESCAPED:
+        return packed[1:].decode('ascii')
+    if packed[0] != PACKED_2BIT:
+        raise ValueError('unknown packed sequence format %d' % packed[0])
+    body = packed[1:-1]
+    sequence = ''.join([_BYTE_TO_BASES[cbyte] for cbyte in body])
+    return sequence[:len(sequence) - packed[-1]]
+
+
+def packed_length(packed):
+    '''Get the length (number of bases) of a packed sequence
+
+    Parameters
+    ----------
+    packed: bytes
+        the packed sequence (from pack_sequence())
+
+    Returns
+    -------
+    int: the sequence length
+    '''
+    if packed[0] == PACKED_2BIT:
+        return (len(packed) - 2) * 4 - packed[-1]
+    return len(packed) - 1
+
+
+def packed_startswith(packed, prefix):
+    '''Test if a packed sequence starts with another packed sequence
+
+    Parameters
+    ----------
+    packed: bytes
+        the packed sequence to test
+    prefix: bytes
+        the packed prefix
+
+    Returns
+    -------
+    bool: True if the sequence of packed starts with the sequence of prefix
+    '''
+    packed = bytes(packed)
+    prefix = bytes(prefix)
+    if packed[0] != PACKED_2BIT or prefix[0] != PACKED_2BIT:
+        return unpack_sequence(packed).startswith(unpack_sequence(prefix))
+    prefix_len = packed_length(prefix)
+    if prefix_len > packed_length(packed):
+        return False
+    num_full, num_partial = divmod(prefix_len, 4)
+    if packed[1:1 + num_full] != prefix[1:1 + num_full]:
+        return False
+    if num_partial == 0:
+        return True
+    mask = (0xff << (8 - 2 * num_partial)) & 0xff
+    return (packed[1 + num_full] & mask) == (prefix[1 + num_full] & mask)
+
+
+def _increment_bytes(value):
+    '''Get the smallest byte string larger than all byte strings starting with value'''
+    value = value.rstrip(b'\xff')
+    return value[:-1] + bytes([value[-1] + 1])
+
+
+def packed_prefix_ranges(sequence):
+    '''Get the ranges of packed values containing all the packed sequences starting with sequence.
+    Used for querying the sequence_packed index. Note the 2 bit range can also contain sequences shorter than sequence
+    (differing only in trailing a's), so matches should be verified (using packed_startswith() or PACKED_LENGTH_SQL).
+    The escaped range contains only sequences starting with sequence
+
+    Parameters
+    ----------
+    sequence: str
+        the sequence prefix to look for
+
+    Returns
+    -------
+    list of (bytes, bytes)
+        the (inclusive start, exclusive end) of each packed value range
+    '''
+    sequence = sequence.lower()
+    escaped = bytes([PACKED_ESCAPED]) + sequence.encode('ascii')
+    ranges = [(escaped, escaped + b'\xff')]
+    if not _is_acgt(sequence):
+        # a sequence with ambiguous bases can only be a prefix of escaped sequences
+        return ranges
+    num_full, num_partial = divmod(len(sequence), 4)
+    body, num_pad = _pack_bases(sequence)
+    start = bytes([PACKED_2BIT]) + body[:num_full]
+    if num_partial == 0:
+        ranges.insert(0, (start, _increment_bytes(start)))
+        return ranges
+    # the last partial byte can have any value for the remaining (padding) bases
+    last = body[num_full]
+    span = 4 ** (4 - num_partial)
+    if last + span < 256:
+        end = start + bytes([last + span])
+    else:
+        end = _increment_bytes(start)
+    ranges.insert(0, (start + bytes([last]), end))
+    return ranges
@@ -0,0 +1,210 @@
+'''Staged (shadow table) loading of the reference tables.
+The new data is loaded into a staging table (TABLE_staging) while the live table keeps serving queries with its indexes.
+When loading is done, the staging table indexes are created and the table is analyzed, and then the staging table
+replaces the live table (using renames in a single transaction).
+'''
+
+from .utils import debug
+
+STAGING_SUFFIX = '_staging'
+
+# the index types (the optional third item of the (index name, index columns, index type) index tuples)
+INDEX_UNIQUE = 'unique'
+INDEX_PRIMARY_KEY = 'primary key'
+
+
+def staging_table_name(table):
+    '''Get the name of the staging table for a table
+
+    Parameters
+    ----------
+    table: str
+        name of the live table
+
+    Returns
+    -------
+    str: the staging table name
+    '''
+    return table.lower() + STAGING_SUFFIX
+
+
+def table_exists(cur, table):
+    '''Test if a table exists (in the current schema search path)
+
+    Parameters
+    ----------
+    cur
+    table: str
+        name of the table
+
+    Returns
+    -------
+    bool
+    '''
+    cur.execute('SELECT to_regclass(%s) IS NOT NULL', [table.lower()])
+    return cur.fetchone()[0]
+
+
+def create_index(cur, table, index, suffix=''):
+    '''Create an index (or a primary key) on a table
+
+    Parameters
+    ----------
+    cur
+    table: str
+        name of the table
+    index: tuple of (str, str) or (str, str, str)
+        the (index name, index columns) or (index name, index columns, index type) of the index.
+        index type is INDEX_UNIQUE or INDEX_PRIMARY_KEY (the primary key constraint is named as the index)
+    suffix: str, optional
+        added to the index name (i.e. STAGING_SUFFIX for the staging table indexes)
+    '''
+    cname = index[0] + suffix
+    ctype = index[2] if len(index) > 2 else None
+    if ctype is None:
+        cur.execute('CREATE INDEX %s ON %s (%s)' % (cname, table, index[1]))
+        return
+    cur.execute('CREATE UNIQUE INDEX %s ON %s (%s)' % (cname, table, index[1]))
+    if ctype == INDEX_PRIMARY_KEY:
+        cur.execute('ALTER TABLE %s ADD CONSTRAINT %s PRIMARY KEY USING INDEX %s' % (table, cname, cname))
+
+
+def drop_index(cur, table, index, suffix=''):
+    '''Drop an index (or a primary key) created by create_index() if it exists
+
+    Parameters
+    ----------
+    cur
+    table: str
+        name of the table
+    index: tuple of (str, str) or (str, str, str)
+        the index (same as create_index())
+    suffix: str, optional
+        added to the index name (same as create_index())
+    '''
+    cname = index[0] + suffix
+    if len(index) > 2 and index[2] == INDEX_PRIMARY_KEY:
+        cur.execute('ALTER TABLE %s DROP CONSTRAINT IF EXISTS %s' % (table, cname))
+    else:
+        cur.execute('DROP INDEX IF EXISTS %s' % cname)
+
+
+def create_staging_table(con, cur, table, copy_existing=True):
+    '''Create the staging table for a table
+
+    Parameters
+    ----------
+    con, cur
+    table: str
+        name of the live table
+    copy_existing: bool, optional
+        True to copy the live table rows to the new staging table (so new rows are added to the existing ones).
+            If the staging table already exists (i.e. from a previous load with no swap), it is used as is (so more rows can be added to it)
+        False to start with an empty staging table (so the new rows replace the existing ones).
+            If the staging table already exists (i.e. from a previous aborted load), it is dropped
+
+    Returns
+    -------
+    str: the staging table name
+    '''
+    staging = staging_table_name(table)
+    if table_exists(cur, staging):
+        if copy_existing:
+            debug(3, 'staging table %s already exists. adding to it' % staging)
+            return staging
+        debug(3, 'staging table %s already exists. dropping it' % staging)
+        cur.execute('DROP TABLE %s' % staging)
+    debug(3, 'creating staging table %s' % staging)
+    cur.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)' % (staging, table))
+    if copy_existing:
+        debug(2, 'copying existing rows from %s to %s' % (table, staging))
+        cur.execute('INSERT INTO %s SELECT * FROM %s' % (staging, table))
+        debug(2, 'copied %d rows' % cur.rowcount)
+    con.commit()
+    return staging
+
+
+def create_staging_indexes(con, cur, table, indexes, parallel_workers=None):
+    '''Create the indexes of the staging table and analyze it (before swapping it in)
+
+    Parameters
+    ----------
+    con, cur
+    table: str
+        name of the live table
+    indexes: list of (str, str) or (str, str, str)
+        the (index name, index columns[, index type]) of the live table indexes (i.e. ('sequenceidstable_prefix_hash_idx', 'prefix_hash')).
+        see create_index(). the staging indexes (and primary key) are named with the STAGING_SUFFIX, and renamed when swapping
+    parallel_workers: int or None, optional
+        number of parallel workers postgres can use for each index build (max_parallel_maintenance_workers)
+        None to use the server default
+    '''
+    staging = staging_table_name(table)
+    if parallel_workers is not None:
+        cur.execute('SET max_parallel_maintenance_workers = %s', [parallel_workers])
+    for cindex in indexes:
+        debug(2, 'creating index %s' % (cindex[0] + STAGING_SUFFIX))
+        drop_index(cur, staging, cindex, suffix=STAGING_SUFFIX)
+        create_index(cur, staging, cindex, suffix=STAGING_SUFFIX)
+    con.commit()
+    debug(2, 'analyzing %s' % staging)
+    cur.execute('ANALYZE %s' % staging)
+    con.commit()
+
+
+def _move_owned_sequences(cur, from_table, to_table):
+    '''Change the owner of the serial column sequences of from_table to the same column in to_table.
+    The staging table column defaults use the live table sequences, so they should not be dropped with the old table
+    '''
+    cur.execute("SELECT s.relname, a.attname FROM pg_depend d JOIN pg_class s ON s.oid = d.objid AND s.relkind = 'S' "
+                "JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid "
+                "WHERE d.refobjid = %s::regclass AND d.deptype = 'a'", [from_table.lower()])
+    for cseq, ccolumn in cur.fetchall():
+        debug(2, 'moving sequence %s to %s.%s' % (cseq, to_table, ccolumn))
+        cur.execute('ALTER SEQUENCE %s OWNED BY %s.%s' % (cseq, to_table, ccolumn))
+
+
+def swap_staging_table(con, cur, table, indexes):
+    '''Replace the live table with the staging table (in a single transaction), and drop the old live table
+
+    Parameters
+    ----------
+    con, cur
+    table: str
+        name of the live table
+    indexes: list of (str, str) or (str, str, str)
+        the table indexes (same as create_staging_indexes())
+    '''
+    swap_staging_tables(con, cur, [(table, indexes)])
+
+
+def swap_staging_tables(con, cur, tables):
+    '''Replace several live tables with their staging tables in a single transaction (for tables referencing each other,
+    i.e. SequenceIDsTable and UniqueSequencesTable), and drop the old live tables
+
+    Parameters
+    ----------
+    con, cur
+    tables: list of (str, list of tuple)
+        the (live table name, table indexes (same as create_staging_indexes())) of each table to swap
+    '''
+    for table, indexes in tables:
+        staging = staging_table_name(table)
+        old = table.lower() + '_old'
+        debug(3, 'swapping %s into %s' % (staging, table))
+        cur.execute('DROP TABLE IF EXISTS %s' % old)
+        cur.execute('ALTER TABLE %s RENAME TO %s' % (table, old))
+        # renaming the index of a primary key also renames the constraint
+        for cindex in indexes:
+            cur.execute('ALTER INDEX IF EXISTS %s RENAME TO %s' % (cindex[0], cindex[0] + '_old'))
+        cur.execute('ALTER TABLE %s RENAME TO %s' % (staging, table))
+        for cindex in indexes:
+            cur.execute('ALTER INDEX %s RENAME TO %s' % (cindex[0] + STAGING_SUFFIX, cindex[0]))
+        _move_owned_sequences(cur, old, table)
+    con.commit()
+    for table, indexes in tables:
+        old = table.lower() + '_old'
+        debug(2, 'dropping old table %s' % old)
+        cur.execute('DROP TABLE %s' % old)
+    con.commit()
+    debug(3, 'swapped %d tables' % len(tables))
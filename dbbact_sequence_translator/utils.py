@@ -127,3 +127,21 @@ def random_str(size=6, chars=string.ascii_uppercase + string.digits):
     random str : string of 6 characters
     """
     return ''.join(random.choice(chars) for _ in range(size))
+
+
+def chunks(data, size):
+    """
+    iterate over a list in consecutive chunks of at most size items
+
+    input:
+    data : list
+        the list to split
+    size : int
+        maximal number of items in each chunk
+
+    output:
+    chunk : list
+        the next chunk of data (same order as data)
+    """
+    for pos in range(0, len(data), size):
+        yield data[pos:pos + size]
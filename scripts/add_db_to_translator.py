@@ -6,55 +6,41 @@ import sys
 import setproctitle
 
 from dbbact_sequence_translator.utils import debug, SetDebugLevel
-from dbbact_sequence_translator import db_access
+from dbbact_sequence_translator import db_access, staging
+from dbbact_sequence_translator.fasta import iter_fasta_seqs
+from dbbact_sequence_translator.seq_pack import pack_sequence
+from dbbact_sequence_translator.seq_hash import prefix_hash
+from dbbact_sequence_translator.bulk_load import copy_rows
 
 
-__version__ = 1.1
+__version__ = 1.3
 
+# the UniqueSequencesTable indices (name, columns[, type]) (see staging.create_index())
+# the packed sequences starting with a given sequence are a contiguous range (see seq_pack.packed_prefix_ranges()),
+# so querying left substring is same speed as exact query
+# this way we can add long sequences to the table and query the subsequence
+# the unique sequence_packed index makes sure each sequence is stored once (also for concurrent loads)
+UNIQUE_SEQUENCES_INDEXES = [('uniquesequencestable_seqkey_idx', 'seqkey', staging.INDEX_PRIMARY_KEY),
+							('uniquesequencestable_sequence_packed_idx', 'sequence_packed', staging.INDEX_UNIQUE),
+							('uniquesequencestable_prefix_hash_idx', 'prefix_hash')]
+# the SequenceIDsTable (sequence key to whole seq id mapping) indices
+SEQUENCE_IDS_INDEXES = [('sequenceidstable_seqkey_idx', 'seqkey'),
+						('sequenceidstable_wsid_idx', 'wsid')]
+# the (temporary) table the fasta file is loaded into before splitting into the unique sequences and the mapping
+LOAD_COLUMNS = ['sequence', 'sequence_packed', 'prefix_hash', 'wholeseqid', 'wholeseqdb', 'region']
 
-def iter_fasta_seqs(filename):
-	"""
-	iterate a fasta file and return header,sequence
-	input:
-	filename - the fasta file name
 
-	output:
-	seq - the sequence
-	header - the header
-	"""
-
-	fl = open(filename, "rU")
-	cseq = ''
-	chead = ''
-	for cline in fl:
-		if cline[0] == '>':
-			if chead:
-				yield(cseq.lower(), chead)
-			cseq = ''
-			chead = cline[1:].rstrip()
-		else:
-			cline = cline.strip().lower()
-			cline = cline.replace('u', 't')
-			cseq += cline.strip()
-	if cseq:
-		yield(cseq, chead)
-	fl.close()
+def iter_sequence_rows(whole_seq_fasta_name, seqdbname, region):
+	'''iterate over the region fasta file and yield the row to load for each sequence
 
+	input:
+	whole_seq_fasta_name - the region fasta file name
+	seqdbname - name of the whole sequence database
+	region - primer region id
 
-def add_db_to_translator(con, cur, seqdbname, whole_seq_fasta_name, region=0, no_index=False):
-	'''
-	**kwargs:
-		server_type=None, database=None, user=None, password=None, port=None, host=None
+	output:
+	(sequence, sequence_packed, prefix_hash, wholeseqid, wholeseqdb, region) tuple
 	'''
-	debug(3, 'add_db_to_translator started for database %s' % seqdbname)
-
-	# since we are inserting lots of values, lets drop the indices and add again at the end
-	debug(1, 'dropping indices')
-	cur.execute('DROP INDEX IF EXISTS sequenceidstable_wholeseqid_idx')
-	cur.execute('DROP INDEX IF EXISTS sequenceidstable_sequence_idx')
-
-	# iterate over the region specific whole sequence fasta file and add all sequences
-	debug(1, 'processing fasta file %s' % whole_seq_fasta_name)
 	seq_count = 0
 	for cseq, chead in iter_fasta_seqs(whole_seq_fasta_name):
 		# lets prepare the id string (sometimes has format 'ID.START.END TAXONOMY' we need to remove)
@@ -66,19 +52,73 @@ def add_db_to_translator(con, cur, seqdbname, whole_seq_fasta_name, region=0, no
 			cid = ".".join(split_cid)
 		cid = cid.lower()
 		cseq = cseq.lower()
-		cur.execute('INSERT INTO SequenceIDsTable (sequence, wholeseqid, wholeseqdb, region) VALUES (%s, %s, %s, %s)', [cseq, cid, seqdbname, region])
+		yield (cseq, pack_sequence(cseq), prefix_hash(cseq), cid, seqdbname, region)
 		seq_count += 1
 		if seq_count % 10000 == 0:
 			debug(1, 'processed %d' % seq_count)
-	debug(2, 'added %s sequences to SequenceIDs table' % seq_count)
+
+
+def add_db_to_translator(con, cur, seqdbname, whole_seq_fasta_name, region=0, no_index=False, batch_size=100000, staged=False, replace=False, parallel_workers=None):
+	'''
+	**kwargs:
+		server_type=None, database=None, user=None, password=None, port=None, host=None
+	batch_size: int, optional
+		number of rows sent in each COPY command
+	staged: bool, optional
+		True to load into the staging tables (so the live tables keep their indices while loading), and swap them into UniqueSequencesTable
+		and SequenceIDsTable when done.
+		if no_index is True, the staging tables are not swapped (so more regions can be added to them)
+	replace: bool, optional
+		if staged, True to start with empty staging tables (the loaded sequences replace the current sequences)
+	parallel_workers: int or None, optional
+		if staged, number of parallel postgres workers for each index build
+	'''
+	debug(3, 'add_db_to_translator started for database %s' % seqdbname)
+
+	if staged:
+		seq_table = staging.create_staging_table(con, cur, 'UniqueSequencesTable', copy_existing=not replace)
+		ids_table = staging.create_staging_table(con, cur, 'SequenceIDsTable', copy_existing=not replace)
+	else:
+		seq_table = 'UniqueSequencesTable'
+		ids_table = 'SequenceIDsTable'
+		# since we are inserting lots of values, lets drop the indices and add again at the end
+		debug(1, 'dropping indices')
+		for cindex in UNIQUE_SEQUENCES_INDEXES:
+			staging.drop_index(cur, 'UniqueSequencesTable', cindex)
+		for cindex in SEQUENCE_IDS_INDEXES:
+			staging.drop_index(cur, 'SequenceIDsTable', cindex)
+
+	# iterate over the region specific whole sequence fasta file and add all sequences (streamed using COPY, reporting rows/sec)
+	debug(1, 'processing fasta file %s' % whole_seq_fasta_name)
+	cur.execute('CREATE TEMP TABLE load_sequences (sequence text, sequence_packed bytea, prefix_hash bigint, wholeseqid text, wholeseqdb text, region integer) ON COMMIT DROP')
+	seq_count = copy_rows(cur, 'load_sequences', LOAD_COLUMNS, iter_sequence_rows(whole_seq_fasta_name, seqdbname, region), batch_size=batch_size)
+	# add the new whole seq ids to the accessions table (SequenceIDsTable stores the integer wsid)
+	cur.execute('INSERT INTO WholeSeqAccessionsTable (wholeseqid) SELECT DISTINCT l.wholeseqid FROM load_sequences l '
+				'WHERE NOT EXISTS (SELECT 1 FROM WholeSeqAccessionsTable a WHERE a.wholeseqid = l.wholeseqid) ON CONFLICT DO NOTHING')
+	debug(2, 'added %d new whole seq ids to WholeSeqAccessionsTable' % cur.rowcount)
+	# deduplicate - add only the sequences not already in the unique sequences table, and map all the whole seq ids to the sequence keys
+	debug(2, 'adding new unique sequences to %s' % seq_table)
+	cur.execute('INSERT INTO %s (sequence, sequence_packed, prefix_hash) '
+				'SELECT DISTINCT ON (l.sequence_packed) l.sequence, l.sequence_packed, l.prefix_hash FROM load_sequences l '
+				'WHERE NOT EXISTS (SELECT 1 FROM %s u WHERE u.sequence_packed = l.sequence_packed)' % (seq_table, seq_table))
+	debug(2, 'added %d unique sequences (out of %d sequences) to %s' % (cur.rowcount, seq_count, seq_table))
+	cur.execute('INSERT INTO %s (seqkey, wsid, wholeseqdb, region) '
+				'SELECT u.seqkey, a.wsid, l.wholeseqdb, l.region FROM load_sequences l JOIN %s u ON u.sequence_packed = l.sequence_packed '
+				'JOIN WholeSeqAccessionsTable a ON a.wholeseqid = l.wholeseqid' % (ids_table, seq_table))
+	debug(2, 'added %s sequences to %s table' % (cur.rowcount, ids_table))
 	if no_index:
 		debug(3, 'skipping add index. NOTE: must add later for optimal performance')
+	elif staged:
+		con.commit()
+		staging.create_staging_indexes(con, cur, 'UniqueSequencesTable', UNIQUE_SEQUENCES_INDEXES, parallel_workers=parallel_workers)
+		staging.create_staging_indexes(con, cur, 'SequenceIDsTable', SEQUENCE_IDS_INDEXES, parallel_workers=parallel_workers)
+		staging.swap_staging_tables(con, cur, [('UniqueSequencesTable', UNIQUE_SEQUENCES_INDEXES), ('SequenceIDsTable', SEQUENCE_IDS_INDEXES)])
 	else:
 		debug(2, 'adding indices')
-		# we use the text_pattern_ops on the index, so querying left substring is same speed as exact query
-		# this way we can add long sequences to the table and query the subsequence
-		cur.execute('CREATE INDEX sequenceidstable_sequence_idx ON SequenceIDsTable (sequence text_pattern_ops)')
-		cur.execute('CREATE INDEX sequenceidstable_wholeseqid_idx ON SequenceIDsTable (wholeseqid)')
+		for cindex in UNIQUE_SEQUENCES_INDEXES:
+			staging.create_index(cur, 'UniqueSequencesTable', cindex)
+		for cindex in SEQUENCE_IDS_INDEXES:
+			staging.create_index(cur, 'SequenceIDsTable', cindex)
 	debug(2, 'commiting')
 	con.commit()
 	debug(2, 'done')
@@ -99,6 +139,10 @@ def main(argv):
 	parser.add_argument('-f', '--wholeseq-file', help='name of the whole sequence region fasta file (can be very long length for each sequence since we use left substring for match)', required=True)
 	parser.add_argument('-w', '--wholeseqdb', help='name of the whole sequence database (i.e. SILVA/GREENGENES)', default='SILVA')
 	parser.add_argument('-r', '--region', help='primer region id (1=v4, 3=v3,... 0 for unspecified)', type=int, default=0)
+	parser.add_argument('--batch-size', help='number of sequences sent to the database in each COPY command', type=int, default=100000)
+	parser.add_argument('--staged', help='load into staging tables and swap them with UniqueSequencesTable/SequenceIDsTable when done (so the server keeps using the indices while loading). with --no-index, the staging tables are kept for adding more regions', action='store_true')
+	parser.add_argument('--replace', help='with --staged, start from an empty staging table (replace all the existing sequences)', action='store_true')
+	parser.add_argument('--parallel-workers', help='with --staged, number of parallel postgres workers for building each index', type=int)
 	args = parser.parse_args(argv)
 
 	SetDebugLevel(args.debug_level)
@@ -109,7 +153,8 @@ def main(argv):
 	# get the database connection
 	con, cur = db_access.connect_translator_db(server_type=args.server_type, database=args.database, user=args.user, password=args.password, port=args.port, host=args.host)
 
-	add_db_to_translator(con, cur, seqdbname=args.wholeseqdb, whole_seq_fasta_name=args.wholeseq_file, region=args.region, no_index=args.no_index)
+	add_db_to_translator(con, cur, seqdbname=args.wholeseqdb, whole_seq_fasta_name=args.wholeseq_file, region=args.region, no_index=args.no_index, batch_size=args.batch_size,
+						staged=args.staged, replace=args.replace, parallel_workers=args.parallel_workers)
 
 
 if __name__ == "__main__":
@@ -2,47 +2,139 @@
 
 import argparse
 import sys
+import multiprocessing
 
 from dbbact_sequence_translator.utils import debug, SetDebugLevel
-from dbbact_sequence_translator import db_access
+from dbbact_sequence_translator import db_access, staging
+from dbbact_sequence_translator.fasta import iter_fasta_seqs
+from dbbact_sequence_translator.bulk_load import copy_rows
 
 '''Add all whole sequence database sequence names, so we can look for exact sequence species matches
 '''
 
-__version__ = 1.1
+__version__ = 1.3
 
+# the columns of the parsed header rows (loaded into a temporary table, and then added to WholeSeqNamesTable using the integer whole seq id)
+WHOLE_SEQ_NAMES_COLUMNS = ['wholeseqid', 'dbid', 'name', 'fullname', 'species', 'search_name']
+# the WholeSeqNamesTable indices (name, columns)
+WHOLE_SEQ_NAMES_INDEXES = [('wholeseqnamestable_wsid_dbid_idx', 'wsid, dbid'),
+							('wholeseqnamestable_wsid_idx', 'wsid'),
+							('wholeseqnamestable_species_idx', 'species text_pattern_ops'),
+							('idx_search_name', 'search_name')]
+
+
+def parse_silva_header(chead):
+	'''get the names for a SILVA fasta header
+
+	input:
+	chead - the fasta header (i.e. 'JQ782411.1.1419 Bacteria;Firmicutes;Bacilli;Lactobacillales;Lactobacillaceae;Lactobacillus;Lactobacillus rhamnosus')
+
+	output:
+	cid - the whole seq id (i.e. 'jq782411')
+	ctax - the lowest level taxonomy name which is not unidentified/uncultured/etc., or None if not found
+	cspecies - the species name ('' if the lowest level taxonomy is not a valid species)
+	'''
+	# lets prepare the id string (sometimes has format 'ID.START.END TAXONOMY' we need to remove)
+	cid = chead.split(' ')[0]
+	split_cid = cid.split('.')
+	if len(split_cid) > 2:
+		cid = ".".join(split_cid[:-2])
+	else:
+		cid = ".".join(split_cid)
+	cid = cid.lower()
+
+	taxstr = ' '.join(chead.split(' ')[1:])
+	tt = taxstr.split(';')
+	lastpos = len(tt) - 1
+	found = False
+	ctax = ''
+	is_species = True
+	while lastpos >= 0:
+		bad = False
+		ctax = tt[lastpos].lower()
+		if len(ctax) == 0:
+			bad = True
+		if ctax.startswith('unidentified'):
+			bad = True
+		elif ctax.startswith('bacterium'):
+			bad = True
+		elif ctax.startswith('uncultured'):
+			bad = True
+		elif ctax.endswith('metagenome'):
+			bad = True
+
+		if bad:
+			is_species = False
+			lastpos -= 1
+			continue
+		found = True
+		break
+	if not found:
+		return cid, None, ''
+	if is_species:
+		return cid, ctax, ctax
+	return cid, ctax, ''
+
+
+def parse_headers_chunk(params):
+	'''get the WholeSeqNamesTable rows for a chunk of fasta headers (run in the worker processes)
 
-def iter_fasta_seqs(filename):
-	"""
-	iterate a fasta file and return header,sequence
 	input:
-	filename - the fasta file name
+	params - tuple of (headers, seqdb_id, add_only_species)
+		headers - list of the fasta headers
+		seqdb_id - the whole seq database id
+		add_only_species - True to skip headers with no species name
 
 	output:
-	seq - the sequence
-	header - the header
-	"""
-
-	fl = open(filename, "rU")
-	cseq = ''
-	chead = ''
-	for cline in fl:
-		if cline[0] == '>':
-			if chead:
-				yield(cseq.lower(), chead)
-			cseq = ''
-			chead = cline[1:].rstrip()
-		else:
-			cline = cline.strip().lower()
-			cline = cline.replace('u', 't')
-			cseq += cline.strip()
-	if cseq:
-		yield(cseq, chead)
-	fl.close()
-
-
-def add_whole_seq_names(con, cur, seqdb_id, whole_seq_fasta_name, db_type, add_only_species=True):
+	rows - list of (wholeseqid, dbid, name, fullname, species, search_name) for the headers to add (same order as headers)
+	no_species - number of headers with no species name
+	num_headers - number of headers in the chunk
 	'''
+	headers, seqdb_id, add_only_species = params
+	rows = []
+	no_species = 0
+	for chead in headers:
+		cid, ctax, cspecies = parse_silva_header(chead)
+		if ctax is None:
+			continue
+		if cspecies == '':
+			no_species += 1
+			# we don't add non-species containing silva ids
+			if add_only_species:
+				continue
+		# for the search_name, remove the [ ] from the species name
+		csearch_name = cspecies.replace('[', '').replace(']', '')
+		rows.append((cid, seqdb_id, ctax, chead.lower(), cspecies, csearch_name))
+	return rows, no_species, len(headers)
+
+
+def iter_header_chunks(whole_seq_fasta_name, seqdb_id, add_only_species, chunk_size):
+	'''iterate over the fasta file and yield chunks of headers for parse_headers_chunk()
+	'''
+	headers = []
+	for cseq, chead in iter_fasta_seqs(whole_seq_fasta_name):
+		headers.append(chead)
+		if len(headers) >= chunk_size:
+			yield headers, seqdb_id, add_only_species
+			headers = []
+	if headers:
+		yield headers, seqdb_id, add_only_species
+
+
+def add_whole_seq_names(con, cur, seqdb_id, whole_seq_fasta_name, db_type, add_only_species=True, num_workers=None, chunk_size=10000, batch_size=100000, staged=False, replace=False, parallel_workers=None):
+	'''
+	num_workers: int or None, optional
+		number of processes used for parsing the headers. None to use the number of cpus
+	chunk_size: int, optional
+		number of headers parsed in each worker task
+	batch_size: int, optional
+		number of rows sent in each COPY command
+	staged: bool, optional
+		True to load into the staging table (so the live table keeps its indices while loading), and swap it into WholeSeqNamesTable when done
+	replace: bool, optional
+		if staged, True to start with an empty staging table (the loaded names replace the current WholeSeqNamesTable names)
+	parallel_workers: int or None, optional
+		if staged, number of parallel postgres workers for each index build
 	'''
 	debug(3, 'add_whole_seq_names started for database %d file %s' % (seqdb_id, whole_seq_fasta_name))
 
@@ -51,87 +143,52 @@ def add_whole_seq_names(con, cur, seqdb_id, whole_seq_fasta_name, db_type, add_o
 	if db_type not in supported_dbs:
 		raise ValueError('database type %s not supported. supported options are: %s' % (db_type, supported_dbs))
 
-	# since we are inserting lots of values, lets drop the indices and add again at the end
-	debug(1, 'dropping indices')
-	cur.execute('DROP INDEX IF EXISTS wholeseqnamestable_wholeseqid_dbid_idx')
-	cur.execute('DROP INDEX IF EXISTS wholeseqnamestable_wholeseqid_idx')
-	cur.execute('DROP INDEX IF EXISTS wholeseqnamestable_species_idx')
-	cur.execute('DROP INDEX IF EXISTS idx_search_name')
+	if staged:
+		table = staging.create_staging_table(con, cur, 'WholeSeqNamesTable', copy_existing=not replace)
+	else:
+		table = 'WholeSeqNamesTable'
+		# since we are inserting lots of values, lets drop the indices and add again at the end
+		debug(1, 'dropping indices')
+		for cname, ccolumns in WHOLE_SEQ_NAMES_INDEXES:
+			cur.execute('DROP INDEX IF EXISTS %s' % cname)
 
 	# iterate over the region specific whole sequence fasta file and add all sequences
+	# the headers are parsed in the worker processes, and the resulting rows (in the original order) are streamed to the database using COPY
 	debug(1, 'processing fasta file %s' % whole_seq_fasta_name)
-	seq_count = 0
-	ok_seqs = 0
-	no_species = 0
-	for cseq, chead in iter_fasta_seqs(whole_seq_fasta_name):
-		seq_count += 1
-		# lets prepare the id string (sometimes has format 'ID.START.END TAXONOMY' we need to remove)
-		cid = chead.split(' ')[0]
-		split_cid = cid.split('.')
-		if len(split_cid) > 2:
-			cid = ".".join(split_cid[:-2])
-		else:
-			cid = ".".join(split_cid)
-		cid = cid.lower()
-		cseq = cseq.lower()
-
-		if db_type == 'silva':
-			taxstr = ' '.join(chead.split(' ')[1:])
-			tt = taxstr.split(';')
-			lastpos = len(tt) - 1
-			found = False
-			ctax = ''
-			is_species = True
-			while lastpos >= 0:
-				bad = False
-				ctax = tt[lastpos].lower()
-				if len(ctax) == 0:
-					bad = True
-				if ctax.startswith('unidentified'):
-					bad = True
-				elif ctax.startswith('bacterium'):
-					bad = True
-				elif ctax.startswith('uncultured'):
-					bad = True
-				elif ctax.endswith('metagenome'):
-					bad = True
-
-				if bad:
-					is_species = False
-					lastpos -= 1
-					continue
-				found = True
-				break
-		else:
-			raise ValueError("unsupported db_type %s" % db_type)
-		if found:
-			if is_species:
-				cspecies = ctax
-			else:
-				no_species += 1
-				cspecies = ''
-				# we don't add non-species containing silva ids
-				if add_only_species:
-					continue
-
-			# for the search_name, remove the [ ] from the species name
-			csearch_name = cspecies.replace('[', '').replace(']','')
-
-			cur.execute('INSERT INTO WholeSeqNamesTable (wholeseqid, dbid, name, fullname, species, search_name) VALUES (%s, %s, %s, %s, %s, %s)', [cid, seqdb_id, ctax, chead.lower(), cspecies, csearch_name])
-			ok_seqs += 1
-		if seq_count % 10000 == 0:
-			debug(1, 'processed %d' % seq_count)
-	debug(2, 'scanned %s, found %d with no species, added %s sequences to SequenceIDs table' % (seq_count, no_species, ok_seqs))
-
-	debug(2, 'adding indices')
-	debug(2, 'wholeseqnamestable_wholeseqid_dbid_idx')
-	cur.execute('CREATE INDEX "wholeseqnamestable_wholeseqid_dbid_idx" ON "public"."wholeseqnamestable"("wholeseqid","dbid")')
-	debug(2, 'wholeseqnamestable_wholeseqid_idx')
-	cur.execute('CREATE INDEX "wholeseqnamestable_wholeseqid_idx" ON "public"."wholeseqnamestable"("wholeseqid")')
-	debug(2, 'wholeseqnamestable_species_idx')
-	cur.execute('CREATE INDEX "wholeseqnamestable_species_idx" ON "public"."wholeseqnamestable"("species" text_pattern_ops)')
-	debug(2, 'idx_search_name')
-	cur.execute('CREATE INDEX "idx_search_name" ON "public"."wholeseqnamestable"("search_name")')
+	counts = {'seqs': 0, 'no_species': 0}
+
+	def iter_rows(results):
+		for rows, no_species, num_headers in results:
+			counts['no_species'] += no_species
+			counts['seqs'] += num_headers
+			for crow in rows:
+				yield crow
+
+	cur.execute('CREATE TEMP TABLE load_names (wholeseqid text, dbid integer, name text, fullname text, species text, search_name text) ON COMMIT DROP')
+	chunks = iter_header_chunks(whole_seq_fasta_name, seqdb_id, add_only_species, chunk_size)
+	if num_workers == 1:
+		ok_seqs = copy_rows(cur, 'load_names', WHOLE_SEQ_NAMES_COLUMNS, iter_rows(map(parse_headers_chunk, chunks)), batch_size=batch_size)
+	else:
+		with multiprocessing.Pool(num_workers) as pool:
+			ok_seqs = copy_rows(cur, 'load_names', WHOLE_SEQ_NAMES_COLUMNS, iter_rows(pool.imap(parse_headers_chunk, chunks)), batch_size=batch_size)
+	# add the new whole seq ids to the accessions table, and add the names using the integer whole seq id
+	cur.execute('INSERT INTO WholeSeqAccessionsTable (wholeseqid) SELECT DISTINCT l.wholeseqid FROM load_names l '
+				'WHERE NOT EXISTS (SELECT 1 FROM WholeSeqAccessionsTable a WHERE a.wholeseqid = l.wholeseqid) ON CONFLICT DO NOTHING')
+	debug(2, 'added %d new whole seq ids to WholeSeqAccessionsTable' % cur.rowcount)
+	cur.execute('INSERT INTO %s (wsid, dbid, name, fullname, species, search_name) '
+				'SELECT a.wsid, l.dbid, l.name, l.fullname, l.species, l.search_name FROM load_names l '
+				'JOIN WholeSeqAccessionsTable a ON a.wholeseqid = l.wholeseqid' % table)
+	debug(2, 'scanned %s, found %d with no species, added %s sequences to %s table' % (counts['seqs'], counts['no_species'], ok_seqs, table))
+
+	if staged:
+		con.commit()
+		staging.create_staging_indexes(con, cur, 'WholeSeqNamesTable', WHOLE_SEQ_NAMES_INDEXES, parallel_workers=parallel_workers)
+		staging.swap_staging_table(con, cur, 'WholeSeqNamesTable', WHOLE_SEQ_NAMES_INDEXES)
+	else:
+		debug(2, 'adding indices')
+		for cname, ccolumns in WHOLE_SEQ_NAMES_INDEXES:
+			debug(2, cname)
+			cur.execute('CREATE INDEX %s ON WholeSeqNamesTable (%s)' % (cname, ccolumns))
 
 	debug(2, 'commiting')
 	con.commit()
@@ -152,6 +209,11 @@ def main(argv):
 	parser.add_argument('-f', '--wholeseq-file', help='name of the whole sequence fasta file (i.e. SILVA/etc.)', required=True)
 	parser.add_argument('-w', '--wholeseqdb', help='id of the whole sequence database (from WholeSeqDatabaseTable, 1 is SILVA 13.2 etc)', type=int, required=True)
 	parser.add_argument('-t', '--db-type', help='type of database added (for header taxonomy parsing) (currently supported: "SILVA")', default='SILVA')
+	parser.add_argument('--num-workers', help='number of processes used for parsing the headers (default is number of cpus)', type=int)
+	parser.add_argument('--batch-size', help='number of rows sent to the database in each COPY command', type=int, default=100000)
+	parser.add_argument('--staged', help='load into a staging table and swap it with WholeSeqNamesTable when done (so the server keeps using the indices while loading)', action='store_true')
+	parser.add_argument('--replace', help='with --staged, start from an empty staging table (replace all the existing names)', action='store_true')
+	parser.add_argument('--parallel-workers', help='with --staged, number of parallel postgres workers for building each index', type=int)
 	args = parser.parse_args(argv)
 
 	SetDebugLevel(args.debug_level)
@@ -159,7 +221,8 @@ def main(argv):
 	# get the database connection
 	con, cur = db_access.connect_translator_db(server_type=args.server_type, database=args.database, user=args.user, password=args.password, port=args.port, host=args.host)
 
-	add_whole_seq_names(con, cur, seqdb_id=args.wholeseqdb, whole_seq_fasta_name=args.wholeseq_file, db_type=args.db_type)
+	add_whole_seq_names(con, cur, seqdb_id=args.wholeseqdb, whole_seq_fasta_name=args.wholeseq_file, db_type=args.db_type, num_workers=args.num_workers, batch_size=args.batch_size,
+						staged=args.staged, replace=args.replace, parallel_workers=args.parallel_workers)
 
 
 if __name__ == "__main__":
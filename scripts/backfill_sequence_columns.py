@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+'''Fill the derived sequence columns for existing rows (after running the database/upgrades scripts)
+'''
+
+import argparse
+import sys
+
+import psycopg2.extras
+import setproctitle
+
+from dbbact_sequence_translator.utils import debug, SetDebugLevel
+from dbbact_sequence_translator import db_access
+from dbbact_sequence_translator.seq_pack import pack_sequence
+from dbbact_sequence_translator.seq_hash import PREFIX_HASH_SQL
+
+
+__version__ = 1.0
+
+SEQUENCE_TABLES = ['UniqueSequencesTable', 'SequenceToSequenceTable', 'NewSequencesTable']
+
+
+def backfill_column(con, cur, table, column, func, batch_size=10000):
+	'''Fill a derived sequence column (i.e. sequence_packed) of all rows in the table which don't have it
+
+	Parameters
+	----------
+	con, cur
+	table: str
+		name of the table to update (from SEQUENCE_TABLES)
+	column: str
+		name of the column to fill
+	func: function
+		calculates the column value from the sequence (str)
+	batch_size: int, optional
+		number of rows to update in each transaction
+	'''
+	debug(3, 'filling %s for table %s' % (column, table))
+	num_rows = 0
+	# we use a cursor with hold so we can commit after each batch
+	with con.cursor(name='backfill_%s_%s' % (table.lower(), column), withhold=True) as read_cur:
+		read_cur.itersize = batch_size
+		read_cur.execute('SELECT ctid, sequence FROM %s WHERE %s IS NULL AND sequence IS NOT NULL' % (table, column))
+		while True:
+			res = read_cur.fetchmany(batch_size)
+			if len(res) == 0:
+				break
+			values = [(cres[0], func(cres[1])) for cres in res]
+			psycopg2.extras.execute_values(cur, 'UPDATE %s AS t SET %s = v.value FROM (VALUES %%s) AS v(row_ctid, value) WHERE t.ctid = v.row_ctid::tid' % (table, column), values, page_size=batch_size)
+			con.commit()
+			num_rows += len(res)
+			debug(1, 'updated %d' % num_rows)
+	con.commit()
+	debug(3, 'filled %s for %d rows in table %s' % (column, num_rows, table))
+
+
+def backfill_column_sql(con, cur, table, column, sql, batch_size=10000):
+	'''Fill a derived sequence column (i.e. prefix_hash) of all rows in the table which don't have it, calculating it in the database
+	The rows are updated in batches of consecutive table blocks (using ctid ranges), so each batch only reads its own blocks
+	(using a tid range scan in postgres 14+. older versions scan the whole table for each batch)
+
+	Parameters
+	----------
+	con, cur
+	table: str
+		name of the table to update (from SEQUENCE_TABLES)
+	column: str
+		name of the column to fill
+	sql: str
+		SQL expression calculating the column value from the sequence column (i.e. PREFIX_HASH_SQL)
+	batch_size: int, optional
+		approximate number of rows to update in each transaction
+	'''
+	debug(3, 'filling %s for table %s' % (column, table))
+	# the updated row versions are not NULL, so blocks added to the table by the updates don't need to be scanned
+	cur.execute("SELECT pg_relation_size(%s::regclass) / current_setting('block_size')::bigint AS num_blocks, GREATEST(reltuples, 1) AS num_tuples "
+				"FROM pg_class WHERE oid = %s::regclass", [table, table])
+	res = cur.fetchone()
+	num_blocks = res['num_blocks']
+	batch_blocks = max(1, int(batch_size * num_blocks / res['num_tuples']))
+	num_rows = 0
+	for cstart in range(0, num_blocks, batch_blocks):
+		cur.execute("UPDATE %s SET %s = %s WHERE ctid >= '(%d,0)'::tid AND ctid < '(%d,0)'::tid AND %s IS NULL AND sequence IS NOT NULL"
+					% (table, column, sql, cstart, cstart + batch_blocks, column))
+		num_rows += cur.rowcount
+		con.commit()
+		debug(1, 'updated %d (block %d/%d)' % (num_rows, min(cstart + batch_blocks, num_blocks), num_blocks))
+	debug(3, 'filled %s for %d rows in table %s' % (column, num_rows, table))
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='backfill_sequence_columns version %s' % __version__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	parser.add_argument('--port', help='postgres port', default=5432, type=int)
+	parser.add_argument('--host', help='postgres host', default=None)
+	parser.add_argument('--server-type', help='server type (develop/main/test). overridden by --database/user/password', default='main')
+	parser.add_argument('--database', help='postgres database')
+	parser.add_argument('--user', help='postgres user')
+	parser.add_argument('--password', help='postgres password')
+	parser.add_argument('--proc-title', help='name of the process (to view in ps aux)')
+	parser.add_argument('--debug-level', help='debug level (1 for debug ... 9 for critical)', default=2, type=int)
+
+	parser.add_argument('--packed', help='fill the sequence_packed column', action='store_true')
+	parser.add_argument('--prefix-hash', help='fill the prefix_hash column', action='store_true')
+	parser.add_argument('-t', '--table', help='tables to update', nargs='*', default=SEQUENCE_TABLES, choices=SEQUENCE_TABLES)
+	parser.add_argument('--batch-size', help='number of rows to update in each transaction', default=10000, type=int)
+	args = parser.parse_args(argv)
+
+	SetDebugLevel(args.debug_level)
+	# set the process name for ps aux
+	if args.proc_title:
+		setproctitle.setproctitle(args.proc_title)
+
+	# get the database connection
+	con, cur = db_access.connect_translator_db(server_type=args.server_type, database=args.database, user=args.user, password=args.password, port=args.port, host=args.host)
+
+	for ctable in args.table:
+		if args.packed:
+			backfill_column(con, cur, ctable, 'sequence_packed', pack_sequence, batch_size=args.batch_size)
+		if args.prefix_hash:
+			backfill_column_sql(con, cur, ctable, 'prefix_hash', PREFIX_HASH_SQL, batch_size=args.batch_size)
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+'''Export the SequenceToSequenceTable into a read-only memory mapped index file.
+The index file can be used by the rest-api server (DBBACT_SEQUENCE_TRANSLATOR_INDEX_FILE) instead of querying the database
+for /get_ids_for_seqs. All the gunicorn workers share the same memory mapped file.
+Need to rebuild after the SequenceToSequenceTable is updated
+'''
+
+import argparse
+import sys
+
+import setproctitle
+
+from dbbact_sequence_translator.utils import debug, SetDebugLevel
+from dbbact_sequence_translator import db_access
+from dbbact_sequence_translator.seq_index import read_sequence_to_sequence_table
+from dbbact_sequence_translator.mmap_index import write_index_file, MmapPrefixIndex
+
+
+__version__ = 1.0
+
+
+def build_translation_index(con, cur, index_file_name, batch_size=10000):
+	'''Create the index file from the SequenceToSequenceTable
+
+	Parameters
+	----------
+	con, cur
+	index_file_name: str
+		name of the output index file
+	batch_size: int, optional
+		number of rows to fetch from the database in each round trip
+	'''
+	debug(3, 'build_translation_index started for file %s' % index_file_name)
+	seq_ids = read_sequence_to_sequence_table(con, batch_size=batch_size)
+	write_index_file(index_file_name, seq_ids)
+	# validate we can read the new file
+	index = MmapPrefixIndex(index_file_name)
+	debug(2, 'index file contains %d sequences' % len(index))
+	index.close()
+	debug(3, 'done')
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='build_translation_index version %s' % __version__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	parser.add_argument('--port', help='postgres port', default=5432, type=int)
+	parser.add_argument('--host', help='postgres host', default=None)
+	parser.add_argument('--server-type', help='server type (develop/main/test). overridden by --database/user/password', default='main')
+	parser.add_argument('--database', help='postgres database')
+	parser.add_argument('--user', help='postgres user')
+	parser.add_argument('--password', help='postgres password')
+	parser.add_argument('--proc-title', help='name of the process (to view in ps aux)')
+	parser.add_argument('--debug-level', help='debug level (1 for debug ... 9 for critical)', default=2, type=int)
+
+	parser.add_argument('-o', '--output', help='name of the output index file', required=True)
+	parser.add_argument('--batch-size', help='number of rows to fetch from the database in each round trip', default=10000, type=int)
+	args = parser.parse_args(argv)
+
+	SetDebugLevel(args.debug_level)
+	# set the process name for ps aux
+	if args.proc_title:
+		setproctitle.setproctitle(args.proc_title)
+
+	# get the database connection
+	con, cur = db_access.connect_translator_db(server_type=args.server_type, database=args.database, user=args.user, password=args.password, port=args.port, host=args.host)
+
+	build_translation_index(con, cur, index_file_name=args.output, batch_size=args.batch_size)
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -7,7 +7,7 @@ original script by Jenya
 modified by Amnon for command line interface and trimming the primer sequences
 """
 
-__version__ = "1.4"
+__version__ = "1.6"
 
 import argparse
 
@@ -15,98 +15,178 @@ import argparse
 # import skbio
 
 import sys
-import re
+import multiprocessing
 
+from dbbact_sequence_translator.fasta import iter_fasta_seqs
+from dbbact_sequence_translator.primer_match import PrimerMatcher
 
-def GetV4(inputname, fprimer, rprimer, length, remove_ambig, keep_primers, skip_reverse, output_mismatch=False):
+
+def extract_region(cseq, seqid, fprimer, rprimer, length, remove_ambig, keep_primers, skip_reverse, output_mismatch=False):
+    """
+    get the amplified region of a single sequence
+
+    input:
+    cseq - the sequence (uppercase)
+    seqid - the sequence header
+    fprimer, rprimer - the forward/reverse primer matchers (PrimerMatcher)
+    other parameters - same as GetV4()
+
+    output:
+    the fasta record to output ('>seqid\nsequence') or None if nothing to output
+    """
     fplen = 0
+    reverse_primer_seq = ''
+    # find the start of the primer and output all following sequence
+    match = fprimer.search(cseq)
+    if match is None:
+        if output_mismatch:
+            return ">%s\n%s" % (seqid, cseq)
+        return None
+    if keep_primers:
+        forward_primer_seq = cseq[match.start():]
+        fplen = match.end() - match.start()
+    else:
+        forward_primer_seq = cseq[match.end():]
+
+    # if sequence can be amplified, search for reverse primer
+    if forward_primer_seq == '':
+        return None
+    if not skip_reverse:
+        # find the reverse primer and output all following sequence
+        match = rprimer.search(forward_primer_seq)
+        if match is None:
+            reverse_primer_seq = ''
+        elif keep_primers:
+            reverse_primer_seq = forward_primer_seq[:match.end()]
+        else:
+            reverse_primer_seq = forward_primer_seq[:match.start()]
+    else:
+        reverse_primer_seq = forward_primer_seq[:length + fplen]
+
+    # if sequence can be amplified, convert back to original strand direction
+    if reverse_primer_seq == '':
+        return None
+    if length > 0:
+        if keep_primers:
+            reverse_primer_seq = reverse_primer_seq[:length + fplen]
+        else:
+            reverse_primer_seq = reverse_primer_seq[:length]
+    printit = True
+    if output_mismatch:
+        printit = not printit
+    if remove_ambig:
+        if 'N' in reverse_primer_seq:
+            printit = False
+    if printit:
+        return ">%s\n%s" % (seqid, reverse_primer_seq)
+    return None
+
+
+def GetV4(inputname, fprimer, rprimer, length, remove_ambig, keep_primers, skip_reverse, output_mismatch=False, max_mismatches=0):
 #    fafile=open(inputname)
 #    for seqid,cseq in MinimalFastaParser(fafile):
 #    it=skbio.io.read(inputname, format='fasta')
 #    for cdat in it:
 #        seqid=cdat.metadata['id']
 #        cseq=str(cdat)
-    for cseq, seqid in iterfastaseqs(inputname):
-        cseq = cseq.upper()
-
-        reverse_primer_seq = ''
-        # find the start of the primer and output all following sequence
-        try:
-            match = re.search(fprimer, cseq)
-            if keep_primers:
-                forward_primer_seq = cseq[match.start():]
-                fplen = match.end() - match.start()
-            else:
-                forward_primer_seq = cseq[match.end():]
-        except AttributeError:
-            forward_primer_seq = ''
-            if output_mismatch:
-                    print(">%s\n%s" % (seqid, cseq))
-
-        # if sequence can be amplified, search for reverse primer
-        if forward_primer_seq != '':
-            if not skip_reverse:
-                # find the reverse primer and output all following sequence
-                try:
-                    match = re.search(rprimer, forward_primer_seq)
-                    if keep_primers:
-                        reverse_primer_seq = forward_primer_seq[:match.end()]
-                    else:
-                        reverse_primer_seq = forward_primer_seq[:match.start()]
-                except AttributeError:
-                    reverse_primer_seq = ''
-            else:
-                reverse_primer_seq = forward_primer_seq[:length + fplen]
-
-            # if sequence can be amplified, convert back to original strand direction
-            if reverse_primer_seq != '':
-                if length > 0:
-                    if keep_primers:
-                        reverse_primer_seq = reverse_primer_seq[:length + fplen]
-                    else:
-                        reverse_primer_seq = reverse_primer_seq[:length]
-                printit = True
-                if output_mismatch:
-                    printit = not printit
-                if remove_ambig:
-                    if 'N' in reverse_primer_seq:
-                        printit = False
-                if printit:
-                    print(">%s\n%s" % (seqid, reverse_primer_seq))
-
-
-def iterfastaseqs(filename):
+    fprimer = PrimerMatcher(fprimer, max_mismatches)
+    rprimer = PrimerMatcher(rprimer, max_mismatches)
+    for cseq, seqid in iter_fasta_seqs(inputname, case='upper'):
+        crecord = extract_region(cseq, seqid, fprimer, rprimer, length, remove_ambig, keep_primers, skip_reverse, output_mismatch)
+        if crecord is not None:
+            print(crecord)
+
+
+# the compiled region primers and extraction options of the worker process (set by _init_region_worker())
+_worker_regions = None
+_worker_options = None
+
+
+def _init_region_worker(regions, options, max_mismatches):
+    global _worker_regions, _worker_options
+
+    _worker_regions = [(PrimerMatcher(cfprimer, max_mismatches), PrimerMatcher(crprimer, max_mismatches)) for cname, cfprimer, crprimer in regions]
+    _worker_options = options
+
+
+def _extract_regions_chunk(records):
     """
-    iterate a fasta file and return header,sequence
+    get the amplified regions of a chunk of sequences for all the regions (run in the worker processes)
+
     input:
-    filename - the fasta file name
+    records - list of (sequence, header)
 
     output:
-    seq - the sequence
-    header - the header
+    list (one per region) of list of the fasta records to output
+    """
+    outputs = [[] for cregion in _worker_regions]
+    for cseq, seqid in records:
+        for cout, (cfprimer, crprimer) in zip(outputs, _worker_regions):
+            crecord = extract_region(cseq, seqid, cfprimer, crprimer, **_worker_options)
+            if crecord is not None:
+                cout.append(crecord)
+    return outputs
+
+
+def _iter_record_chunks(inputname, chunk_size):
+    chunk = []
+    for crecord in iter_fasta_seqs(inputname, case='upper'):
+        chunk.append(crecord)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def GetRegions(inputname, regions, output_prefix, length, remove_ambig, keep_primers, skip_reverse, output_mismatch=False, max_mismatches=0, num_workers=None, chunk_size=1000):
     """
+    extract several regions in one pass over the input fasta file. each region is written to the file output_prefix + region name + '.fa'
+    the sequences are processed in a process pool, and the output order is the same as the input order
 
-    fl = open(filename, "rU")
-    cseq = ''
-    chead = ''
-    for cline in fl:
-        if cline[0] == '>':
-            if chead:
-                yield(cseq, chead)
-            cseq = ''
-            chead = cline[1:].rstrip()
-        else:
-            cseq += cline.strip().replace('U', 'T')
-    if cseq:
-        yield(cseq, chead)
-    fl.close()
+    input:
+    regions - list of (name, forward primer, reverse primer)
+    num_workers - number of worker processes (None for number of cpus)
+    chunk_size - number of sequences processed in each worker task
+    other parameters - same as GetV4()
+    """
+    options = {'length': length, 'remove_ambig': remove_ambig, 'keep_primers': keep_primers, 'skip_reverse': skip_reverse, 'output_mismatch': output_mismatch}
+    outfiles = [open('%s%s.fa' % (output_prefix, cname), 'w') for cname, cfprimer, crprimer in regions]
+    try:
+        with multiprocessing.Pool(num_workers, initializer=_init_region_worker, initargs=(regions, options, max_mismatches)) as pool:
+            for coutputs in pool.imap(_extract_regions_chunk, _iter_record_chunks(inputname, chunk_size)):
+                for cfile, cout in zip(outfiles, coutputs):
+                    for crecord in cout:
+                        cfile.write(crecord + '\n')
+    finally:
+        for cfile in outfiles:
+            cfile.close()
+
+
+def parse_region(region, default_rprimer):
+    """
+    parse a region command line parameter
+
+    input:
+    region - 'NAME:FPRIMER' or 'NAME:FPRIMER:RPRIMER'
+    default_rprimer - the reverse primer to use if not supplied
+
+    output:
+    (name, forward primer, reverse primer)
+    """
+    parts = region.split(':')
+    if len(parts) == 2:
+        return parts[0], parts[1], default_rprimer
+    if len(parts) == 3:
+        return parts[0], parts[1], parts[2]
+    raise ValueError('region %s should be in the format NAME:FPRIMER or NAME:FPRIMER:RPRIMER' % region)
 
 
 def main(argv):
     parser = argparse.ArgumentParser(description='Extract an amplified region from a set of primers version ' + __version__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-i', '--input', help='name of input fasta file')
     # parser.add_argument('-d','--indir',help='input directory of fastq files (instead of -i)',default="")
-    parser.add_argument('-f', '--fprimer', help='forward primer sequence (default is V4f)', default='GTGCCAGC[AC]GCCGCGGTAA')
+    parser.add_argument('-f', '--fprimer', help='forward primer sequence (IUPAC codes or [] classes) (default is V4f)', default='GTGCCAGC[AC]GCCGCGGTAA')
     # parser.add_argument('-r','--rprimer',help='reverse primer sequence',default='GGACTAC[ACT][ACG]GGGT[AT]TCTAAT')
     parser.add_argument('-r', '--rprimer', help='reverse primer sequence (in reverse complement) (default is V4r)', default='ATTAGA[AT]ACCC[CGT][AGT]GTAGTCC')
     parser.add_argument('-l', '--length', help='Trim all sequences to length (0 for full length)', default='0')
@@ -114,6 +194,10 @@ def main(argv):
     parser.add_argument('-s', '--skip_reverse', help='Dont look for reverse primer', action='store_true')
     parser.add_argument('-k', '--keep_primers', help="Don't remove the primer sequences", action='store_true')
     parser.add_argument('-m', '--output_mismatch', help="show sequences with no primer instead", action='store_true')
+    parser.add_argument('-e', '--max_mismatches', help='maximal number of mismatches allowed in each primer match', type=int, default=0)
+    parser.add_argument('-R', '--region', help='extract several regions in one pass (instead of -f). format is NAME:FPRIMER or NAME:FPRIMER:RPRIMER (using -r if RPRIMER not supplied). each region is written to OUTPUT_PREFIX + NAME + .fa', action='append')
+    parser.add_argument('-o', '--output_prefix', help='output files prefix when using --region', default='')
+    parser.add_argument('-p', '--num_workers', help='number of processes when using --region (default is number of cpus)', type=int)
 
     args = parser.parse_args(argv)
 
@@ -127,7 +211,12 @@ def main(argv):
     # # otherwise use the file list
     #     fasta=[args.infile]
 
-    GetV4(args.input, args.fprimer, args.rprimer, int(args.length), args.remove_ambig, args.keep_primers, args.skip_reverse, args.output_mismatch)
+    if args.region:
+        regions = [parse_region(cregion, args.rprimer) for cregion in args.region]
+        GetRegions(args.input, regions, args.output_prefix, int(args.length), args.remove_ambig, args.keep_primers, args.skip_reverse, args.output_mismatch, max_mismatches=args.max_mismatches, num_workers=args.num_workers)
+        return
+
+    GetV4(args.input, args.fprimer, args.rprimer, int(args.length), args.remove_ambig, args.keep_primers, args.skip_reverse, args.output_mismatch, args.max_mismatches)
 
 
 if __name__ == "__main__":
@@ -5,10 +5,16 @@
 
 '''Put all dbBact sequences in to the sequence translator update queue
 need to run after adding a new whole seq database / region
+The sequences are read using a server side cursor (ordered by id) and sent in chunks. After each chunk is added, the last sent id
+is saved to the checkpoint file, so an interrupted import continues from the last chunk when running again
+(the checkpoint file is deleted when the import is complete).
 '''
 
+import os
 import sys
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 import argparse
 import setproctitle
@@ -16,24 +22,107 @@ import setproctitle
 from dbbact_server import db_access
 from dbbact_server.utils import debug, SetDebugLevel
 
-__version__ = "0.9"
+__version__ = "1.0"
 
 
-def add_seq_counts(con, cur, seq_trans_addr='http://127.0.0.1:5021'):
+def get_session(retries=5, backoff_factor=1):
+	'''Get a keep-alive requests session which retries failed requests
+
+	Parameters
+	----------
+	retries: int, optional
+		maximal number of retries for each request
+	backoff_factor: float, optional
+		the retries wait backoff_factor * (2 ** (retry number - 1)) seconds
+
+	Returns
+	-------
+	requests.Session
+	'''
+	# retrying the POST is safe since sequences already in the queue are skipped by the server
+	retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=[500, 502, 503, 504], allowed_methods=['POST'])
+	session = requests.Session()
+	session.mount('http://', HTTPAdapter(max_retries=retry))
+	session.mount('https://', HTTPAdapter(max_retries=retry))
+	return session
+
+
+def read_checkpoint(checkpoint_file):
+	'''Get the last dbbact sequence id added (from the checkpoint file)
+
+	Parameters
+	----------
+	checkpoint_file: str or None
+		name of the checkpoint file, or None to not use a checkpoint
+
+	Returns
+	-------
+	int: the last sequence id added, or 0 if no checkpoint
+	'''
+	if checkpoint_file is None or not os.path.exists(checkpoint_file):
+		return 0
+	with open(checkpoint_file) as fl:
+		last_id = int(fl.read().strip() or 0)
+	debug(3, 'continuing from checkpoint file %s (last id %d)' % (checkpoint_file, last_id))
+	return last_id
+
+
+def write_checkpoint(checkpoint_file, last_id):
+	'''Save the last dbbact sequence id added to the checkpoint file (replacing it atomically)
+	'''
+	if checkpoint_file is None:
+		return
+	tmp_file = checkpoint_file + '.tmp'
+	with open(tmp_file, 'w') as fl:
+		fl.write('%d\n' % last_id)
+	os.replace(tmp_file, checkpoint_file)
+
+
+def add_seq_counts(con, cur, seq_trans_addr='http://127.0.0.1:5021', chunk_size=10000, checkpoint_file=None, retries=5, timeout=600):
+	'''Add all the dbbact sequences to the sequence translator queue
+
+	Parameters
+	----------
+	con, cur
+		the dbbact database connection
+	seq_trans_addr: str, optional
+		the sequence translator rest-api address
+	chunk_size: int, optional
+		number of sequences sent in each request
+	checkpoint_file: str or None, optional
+		name of the file storing the last sequence id added (for continuing an interrupted import). None to not use a checkpoint
+	retries: int, optional
+		maximal number of retries for each request
+	timeout: float, optional
+		timeout (seconds) for each request
+	'''
 	debug(3, 'import_all_seqs started')
+	last_id = read_checkpoint(checkpoint_file)
+	session = get_session(retries=retries)
+	num_seqs = 0
 	debug(2, 'processing sequences')
-	cur.execute('SELECT id, sequence FROM SequencesTable')
-	seq_info = {}
-	for cres in cur:
-		cid = cres['id']
-		cseq = cres['sequence']
-		seq_info[cid] = cseq
-	debug(2, 'found %d sequences' % len(seq_info))
-	debug(2, 'adding to newsequencestable using rest-api')
-	res = requests.post(seq_trans_addr + '/add_sequences_to_queue', json={'seq_info': seq_info})
-	if res.status_code != 200:
-		debug(5, 'failed! %s' % res.content)
-	debug(3, 'done')
+	# use a server side cursor so we don't load all the sequences into memory
+	with con.cursor(name='import_all_seqs') as read_cur:
+		read_cur.itersize = chunk_size
+		read_cur.execute('SELECT id, sequence FROM SequencesTable WHERE id > %s ORDER BY id', [last_id])
+		while True:
+			res = read_cur.fetchmany(chunk_size)
+			if len(res) == 0:
+				break
+			seq_info = {cres[0]: cres[1] for cres in res}
+			resp = session.post(seq_trans_addr + '/add_sequences_to_queue', json={'seq_info': seq_info}, timeout=timeout)
+			if resp.status_code != 200:
+				debug(5, 'failed! %s' % resp.content)
+				raise ValueError('failed adding sequences to queue after id %d: %s' % (last_id, resp.content))
+			last_id = max(seq_info.keys())
+			write_checkpoint(checkpoint_file, last_id)
+			num_seqs += len(seq_info)
+			debug(2, 'added %d sequences (last id %d)' % (num_seqs, last_id))
+	con.rollback()
+	# the import is complete, so the next import should start from the beginning
+	if checkpoint_file is not None and os.path.exists(checkpoint_file):
+		os.remove(checkpoint_file)
+	debug(3, 'done. added %d sequences' % num_seqs)
 
 
 def main(argv):
@@ -46,6 +135,10 @@ def main(argv):
 	parser.add_argument('--proc-title', help='name of the process (to view in ps aux)')
 	parser.add_argument('--debug-level', help='debug level (1 for debug ... 9 for critical)', default=2, type=int)
 	parser.add_argument('--seq-trans-addr', help='sequence translator rest-api address', default='http://127.0.0.1:5021')
+	parser.add_argument('--chunk-size', help='number of sequences sent in each request', default=10000, type=int)
+	parser.add_argument('--checkpoint', help='checkpoint file for continuing an interrupted import (delete it to start over)', default='import_all_seqs.checkpoint')
+	parser.add_argument('--retries', help='maximal number of retries for each request', default=5, type=int)
+	parser.add_argument('--timeout', help='timeout (seconds) for each request', default=600, type=float)
 	args = parser.parse_args(argv)
 
 	SetDebugLevel(args.debug_level)
@@ -54,7 +147,7 @@ def main(argv):
 		setproctitle.setproctitle(args.proc_title)
 
 	con, cur = db_access.connect_db(database=args.database, user=args.user, password=args.password, port=args.port, host=args.host)
-	add_seq_counts(con, cur, seq_trans_addr=args.seq_trans_addr)
+	add_seq_counts(con, cur, seq_trans_addr=args.seq_trans_addr, chunk_size=args.chunk_size, checkpoint_file=args.checkpoint, retries=args.retries, timeout=args.timeout)
 
 
 if __name__ == "__main__":
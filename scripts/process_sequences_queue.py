@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+'''Process the dbbact sequences waiting in the NewSequencesTable queue (added using /add_sequences_to_queue).
+Each queued sequence is matched to the whole seq ids (i.e. SILVA ids) of all the region sequences starting with it,
+and the matches are added to the WholeSeqIDsTable.
+Several worker processes can process the queue concurrently (each batch of rows is claimed using FOR UPDATE SKIP LOCKED).
+When all the workers are done, the SequenceToSequenceTable is updated for the new WholeSeqIDsTable rows
+'''
+
+import argparse
+import sys
+import multiprocessing
+
+import setproctitle
+
+from dbbact_sequence_translator.utils import debug, SetDebugLevel
+from dbbact_sequence_translator import db_access, db_translate
+
+
+__version__ = 1.0
+
+
+def process_sequences_queue(con, cur, dbid, batch_size=db_translate.QUEUE_BATCH_SIZE):
+	'''Process queue batches until the queue is empty
+
+	Parameters
+	----------
+	con, cur
+	dbid: int
+		the whole seq database id for the new WholeSeqIDsTable rows
+	batch_size: int, optional
+		number of queued sequences processed in each transaction
+
+	Returns
+	-------
+	num_processed: int
+		number of queued sequences processed
+	num_added: int
+		number of rows added to WholeSeqIDsTable
+	'''
+	total_processed = 0
+	total_added = 0
+	while True:
+		err, num_processed, num_added = db_translate.process_queue_batch(con, cur, dbid, batch_size=batch_size)
+		if err:
+			raise ValueError(err)
+		if num_processed == 0:
+			break
+		total_processed += num_processed
+		total_added += num_added
+		debug(2, 'processed %d queued sequences so far' % total_processed)
+	debug(3, 'processed %d queued sequences, added %d whole seq ids' % (total_processed, total_added))
+	return total_processed, total_added
+
+
+def _queue_worker(params):
+	'''Process the queue using a new database connection (run in the worker processes)
+
+	input:
+	params - tuple of (db_params, dbid, batch_size, debug_level)
+		db_params - dict of the connect_translator_db() parameters
+
+	output:
+	(num_processed, num_added)
+	'''
+	db_params, dbid, batch_size, debug_level = params
+	SetDebugLevel(debug_level)
+	con, cur = db_access.connect_translator_db(**db_params)
+	try:
+		return process_sequences_queue(con, cur, dbid, batch_size=batch_size)
+	finally:
+		con.close()
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='process_sequences_queue version %s' % __version__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	parser.add_argument('--port', help='postgres port', default=5432, type=int)
+	parser.add_argument('--host', help='postgres host', default=None)
+	parser.add_argument('--server-type', help='server type (develop/main/test). overridden by --database/user/password', default='main')
+	parser.add_argument('--database', help='postgres database')
+	parser.add_argument('--user', help='postgres user')
+	parser.add_argument('--password', help='postgres password')
+	parser.add_argument('--proc-title', help='name of the process (to view in ps aux)')
+	parser.add_argument('--debug-level', help='debug level (1 for debug ... 9 for critical)', default=2, type=int)
+
+	parser.add_argument('-w', '--wholeseqdb', help='name of the whole sequence database (i.e. SILVA/GREENGENES)', default='SILVA')
+	parser.add_argument('--wholeseqdb-version', help='version of the whole sequence database (default is the latest version)')
+	parser.add_argument('--batch-size', help='number of queued sequences processed in each transaction', default=db_translate.QUEUE_BATCH_SIZE, type=int)
+	parser.add_argument('--workers', help='number of concurrent worker processes', default=1, type=int)
+	parser.add_argument('--no-update', help='do not update the SequenceToSequenceTable after processing the queue', action='store_true')
+	parser.add_argument('--update-batch-size', help='number of new WholeSeqIDsTable rows handled in each SequenceToSequenceTable update transaction', default=db_translate.STS_UPDATE_BATCH_SIZE, type=int)
+	args = parser.parse_args(argv)
+
+	SetDebugLevel(args.debug_level)
+	# set the process name for ps aux
+	if args.proc_title:
+		setproctitle.setproctitle(args.proc_title)
+
+	# get the database connection
+	db_params = {'server_type': args.server_type, 'database': args.database, 'user': args.user, 'password': args.password, 'port': args.port, 'host': args.host}
+	con, cur = db_access.connect_translator_db(**db_params)
+
+	err, dbid = db_translate.get_whole_seq_db_id_from_name(con, cur, args.wholeseqdb, args.wholeseqdb_version)
+	if err:
+		raise ValueError('whole seq database %s not found: %s' % (args.wholeseqdb, err))
+
+	if args.workers <= 1:
+		process_sequences_queue(con, cur, dbid, batch_size=args.batch_size)
+	else:
+		# don't keep the main connection idle in transaction while the workers run
+		con.commit()
+		with multiprocessing.Pool(args.workers) as pool:
+			res = pool.map(_queue_worker, [(db_params, dbid, args.batch_size, args.debug_level)] * args.workers)
+		debug(3, 'all workers done. processed %d queued sequences, added %d whole seq ids' % (sum([x[0] for x in res]), sum([x[1] for x in res])))
+
+	if not args.no_update:
+		err, num_updated = db_translate.update_sequence_to_sequence(con, cur, batch_size=args.update_batch_size)
+		if err:
+			raise ValueError(err)
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+'''Rebuild the SequenceToSequenceTable from the UniqueSequencesTable/SequenceIDsTable and WholeSeqIDsTable (i.e. after loading a new SILVA release).
+For each region sequence, the dbbactids are all the dbbact ids matching any of the whole seq ids of the region sequence.
+The region sequences are partitioned by their prefix (a contiguous sequence_packed range for each prefix, see seq_pack.packed_prefix_ranges()),
+and the partitions are computed in parallel (each worker process uses a separate database connection) into a staging table,
+which replaces the SequenceToSequenceTable when done.
+NOTE: the sequence_packed column of the UniqueSequencesTable must be filled (see backfill_sequence_columns.py)
+'''
+
+import argparse
+import sys
+import itertools
+import multiprocessing
+import time
+
+import setproctitle
+
+from dbbact_sequence_translator.utils import debug, SetDebugLevel
+from dbbact_sequence_translator import db_access, staging
+from dbbact_sequence_translator.seq_pack import packed_prefix_ranges, PACKED_ESCAPED
+
+
+__version__ = 1.0
+
+# the SequenceToSequenceTable indices (name, columns[, type]) (see staging.create_index())
+# the unique sequence_packed index is used by the incremental updates (db_translate.update_sequence_to_sequence())
+SEQUENCE_TO_SEQUENCE_INDEXES = [('sequencetosequencetable_sequence_packed_idx', 'sequence_packed', staging.INDEX_UNIQUE),
+								('sequencetosequencetable_prefix_hash_idx', 'prefix_hash')]
+
+# the database connection of the worker process (set by _init_worker())
+_worker_db = {}
+
+
+def get_prefix_partitions(prefix_length):
+	'''Get the sequence_packed ranges for partitioning the region sequences by prefix
+
+	Parameters
+	----------
+	prefix_length: int
+		length of the prefix. there are 4**prefix_length partitions for the 2 bit packed sequences, and one for the escaped sequences
+		(containing non acgt characters)
+
+	Returns
+	-------
+	list of (bytes, bytes)
+		the (inclusive start, exclusive end) sequence_packed range of each partition. the ranges are disjoint and cover all the packed values
+	'''
+	partitions = []
+	for cprefix in itertools.product('acgt', repeat=prefix_length):
+		partitions.append(packed_prefix_ranges(''.join(cprefix))[0])
+	# the first partition also contains the (empty) sequences shorter than the first prefix range start
+	partitions[0] = (b'', partitions[0][1])
+	partitions.append((bytes([PACKED_ESCAPED]), bytes([PACKED_ESCAPED + 1])))
+	return partitions
+
+
+def _init_worker(db_params, debug_level):
+	'''Open the database connection of the worker process'''
+	SetDebugLevel(debug_level)
+	con, cur = db_access.connect_translator_db(**db_params)
+	_worker_db['con'] = con
+	_worker_db['cur'] = cur
+
+
+def _rebuild_partition(params):
+	'''Add the SequenceToSequenceTable rows of one partition to the staging table (run in the worker processes)
+
+	input:
+	params - tuple of (table, lo, hi)
+		table - name of the table to add the rows to
+		lo, hi - the sequence_packed range of the partition
+
+	output:
+	number of rows added
+	'''
+	table, lo, hi = params
+	con = _worker_db['con']
+	cur = _worker_db['cur']
+	cur.execute('INSERT INTO %s (sequence, sequence_packed, prefix_hash, dbbactids) '
+				'SELECT u.sequence, u.sequence_packed, u.prefix_hash, array_agg(DISTINCT w.dbbactid ORDER BY w.dbbactid) '
+				'FROM UniqueSequencesTable u JOIN SequenceIDsTable s ON s.seqkey = u.seqkey JOIN WholeSeqIDsTable w ON w.wsid = s.wsid '
+				'WHERE u.sequence_packed >= %%s AND u.sequence_packed < %%s '
+				'GROUP BY u.seqkey, u.sequence, u.sequence_packed, u.prefix_hash' % table, [lo, hi])
+	num_rows = cur.rowcount
+	con.commit()
+	return num_rows
+
+
+def rebuild_sequence_to_sequence(con, cur, db_params, num_workers=None, prefix_length=3, parallel_workers=None, debug_level=2):
+	'''Rebuild the SequenceToSequenceTable
+
+	Parameters
+	----------
+	con, cur
+	db_params: dict
+		the connect_translator_db() parameters (for the worker processes connections)
+	num_workers: int or None, optional
+		number of worker processes. None to use the number of cpus
+	prefix_length: int, optional
+		the region sequences are partitioned by prefixes of this length (4**prefix_length partitions)
+	parallel_workers: int or None, optional
+		number of parallel postgres workers for each index build
+	debug_level: int, optional
+		the debug level of the worker processes
+	'''
+	debug(3, 'rebuild_sequence_to_sequence started')
+	start_time = time.time()
+	# the WholeSeqIDsTable rows included in the rebuild (for the incremental updates - see db_translate.update_sequence_to_sequence())
+	cur.execute('SELECT max(id) AS max_id FROM WholeSeqIDsTable')
+	max_id = cur.fetchone()['max_id'] or 0
+	cur.execute('SELECT count(*) AS num_missing FROM UniqueSequencesTable WHERE sequence_packed IS NULL')
+	num_missing = cur.fetchone()['num_missing']
+	if num_missing > 0:
+		raise ValueError('%d UniqueSequencesTable rows have no sequence_packed. run backfill_sequence_columns.py --packed first' % num_missing)
+	# start from an empty staging table (an existing staging table from an aborted rebuild is dropped)
+	table = staging.create_staging_table(con, cur, 'SequenceToSequenceTable', copy_existing=False)
+
+	partitions = get_prefix_partitions(prefix_length)
+	debug(2, 'computing %d partitions' % len(partitions))
+	num_rows = 0
+	with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(db_params, debug_level)) as pool:
+		for cpos, cnum_rows in enumerate(pool.imap_unordered(_rebuild_partition, [(table, lo, hi) for lo, hi in partitions])):
+			num_rows += cnum_rows
+			debug(1, 'done %d/%d partitions, %d rows (%.1f sec)' % (cpos + 1, len(partitions), num_rows, time.time() - start_time))
+	debug(2, 'added %d rows to %s (%.1f sec)' % (num_rows, table, time.time() - start_time))
+
+	staging.create_staging_indexes(con, cur, 'SequenceToSequenceTable', SEQUENCE_TO_SEQUENCE_INDEXES, parallel_workers=parallel_workers)
+	staging.swap_staging_table(con, cur, 'SequenceToSequenceTable', SEQUENCE_TO_SEQUENCE_INDEXES)
+	cur.execute('UPDATE SequenceToSequenceStateTable SET last_wholeseqids_id = %s', [max_id])
+	con.commit()
+	debug(3, 'rebuild_sequence_to_sequence done. %d rows in %.1f sec' % (num_rows, time.time() - start_time))
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='rebuild_sequence_to_sequence version %s' % __version__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	parser.add_argument('--port', help='postgres port', default=5432, type=int)
+	parser.add_argument('--host', help='postgres host', default=None)
+	parser.add_argument('--server-type', help='server type (develop/main/test). overridden by --database/user/password', default='main')
+	parser.add_argument('--database', help='postgres database')
+	parser.add_argument('--user', help='postgres user')
+	parser.add_argument('--password', help='postgres password')
+	parser.add_argument('--proc-title', help='name of the process (to view in ps aux)')
+	parser.add_argument('--debug-level', help='debug level (1 for debug ... 9 for critical)', default=2, type=int)
+
+	parser.add_argument('--workers', help='number of worker processes (default is the number of cpus)', type=int)
+	parser.add_argument('--prefix-length', help='length of the sequence prefix used for partitioning (4**prefix_length partitions)', default=3, type=int)
+	parser.add_argument('--parallel-workers', help='number of parallel postgres workers for building each index', type=int)
+	args = parser.parse_args(argv)
+
+	SetDebugLevel(args.debug_level)
+	# set the process name for ps aux
+	if args.proc_title:
+		setproctitle.setproctitle(args.proc_title)
+
+	# get the database connection
+	db_params = {'server_type': args.server_type, 'database': args.database, 'user': args.user, 'password': args.password, 'port': args.port, 'host': args.host}
+	con, cur = db_access.connect_translator_db(**db_params)
+
+	rebuild_sequence_to_sequence(con, cur, db_params, num_workers=args.workers, prefix_length=args.prefix_length,
+								parallel_workers=args.parallel_workers, debug_level=args.debug_level)
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])